@@ -1,13 +1,33 @@
 import os
+import io
 import json
 import sqlite3
 import datetime
 import threading
 import time
 import random
-from contextlib import closing
-from flask import Flask, request, jsonify, abort, redirect, url_for, render_template_string, flash, make_response
+import gzip
+import tempfile
+import zlib
+import sys
+import cProfile
+import pstats
+try:
+    import fcntl  # Khóa file giữa các worker Gunicorn (không có trên Windows)
+except ImportError:
+    fcntl = None
+from contextlib import closing, contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+from urllib.parse import urlsplit
+from collections import OrderedDict, deque
+from bisect import bisect_left
+from flask import Flask, request, jsonify, abort, redirect, url_for, render_template, flash, make_response, Response, stream_with_context, send_file, g
 import requests
+from requests.adapters import HTTPAdapter
+from jinja2 import DictLoader
+
+# Mốc thời gian bắt đầu import (để đo thời gian khởi động).
+BOOT_STARTED_AT = time.time()
 
 # ==============================================================================
 # ==============================================================================
@@ -24,6 +44,11 @@ import requests
 # Đường dẫn đến file Database SQLite.
 DB = os.getenv("DB_PATH", "store.db") 
 
+# Tinh chỉnh SQLite (áp dụng cho mọi kết nối trong pool).
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "20000"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+
 # ------------------------------------------------------------------------------
 # 1.2 Cấu hình Backup & Restore
 # ------------------------------------------------------------------------------
@@ -31,6 +56,12 @@ DB = os.getenv("DB_PATH", "store.db")
 SECRET_BACKUP_FILE_PATH = os.getenv("SECRET_BACKUP_FILE_PATH", "/etc/secrets/backupapitaphoa.json")
 # Tên file backup tự động sinh ra
 AUTO_BACKUP_FILE = "auto_backup.json"
+# Nén gzip file backup tự động (file sẽ có đuôi .json.gz)
+AUTO_BACKUP_COMPRESS = os.getenv("AUTO_BACKUP_COMPRESS", "0") == "1"
+# Backup gia tăng: nhật ký thay đổi (change_log) + file delta mỗi giờ, bản đầy đủ sau mỗi N lần chạy.
+BACKUP_JOURNAL = os.getenv("BACKUP_JOURNAL", "1") == "1"
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+AUTO_BACKUP_FULL_EVERY = int(os.getenv("AUTO_BACKUP_FULL_EVERY", "24"))
 
 # ------------------------------------------------------------------------------
 # 1.3 Cấu hình Bảo mật & Ứng dụng
@@ -42,7 +73,80 @@ ADMIN_SECRET = os.getenv("ADMIN_SECRET", "CHANGE_ME")
 DEFAULT_TIMEOUT = int(os.getenv("DEFAULT_TIMEOUT", "5")) 
 
 # Thời gian (giây) giữa các lần kiểm tra Proxy tự động.
-PROXY_CHECK_INTERVAL = 15 
+PROXY_CHECK_INTERVAL = 15
+
+# Số proxy được kiểm tra song song và thời hạn tối đa (giây) cho 1 lượt quét.
+PROXY_CHECK_CONCURRENCY = int(os.getenv("PROXY_CHECK_CONCURRENCY", "20"))
+PROXY_SWEEP_DEADLINE = float(os.getenv("PROXY_SWEEP_DEADLINE", "30"))
+
+# Định tuyến nhiều proxy: chia request ra ngoài cho mọi proxy đang sống, trọng số theo
+# EWMA độ trễ thực tế & tỉ lệ lỗi (ALPHA = trọng số của mẫu mới). Tắt = chỉ dùng 1 proxy hiện tại như cũ.
+PROXY_ROUTING = os.getenv("PROXY_ROUTING", "1") == "1"
+PROXY_EWMA_ALPHA = float(os.getenv("PROXY_EWMA_ALPHA", "0.3"))
+
+# Pool kết nối HTTP keep-alive (requests.Session) theo cặp (host upstream, proxy).
+# POOL_MAXSIZE = số kết nối giữ lại tối đa cho mỗi host, MAX_SESSIONS = số Session tối thiểu được giữ;
+# khi định tuyến nhiều proxy, giới hạn tự nới lên (số host × số proxy sống) để không xoay vòng LRU.
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "10"))
+HTTP_POOL_MAX_SESSIONS = int(os.getenv("HTTP_POOL_MAX_SESSIONS", "256"))
+
+# Số dòng mỗi lô khi nhập kho hàng loạt (executemany + commit theo lô, RAM giới hạn theo lô).
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "5000"))
+
+# Số dòng mỗi lô executemany khi khôi phục từ file backup (toàn bộ restore vẫn nằm trong 1 transaction).
+RESTORE_BATCH_SIZE = int(os.getenv("RESTORE_BATCH_SIZE", "20000"))
+
+# Số dòng mỗi lô khi xuất kho (tải file TXT dạng stream).
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "5000"))
+
+# Trang xem kho: số dòng mỗi trang, và bật/tắt chỉ mục tìm kiếm FTS5 (trigram) cho nội dung kho.
+STOCK_VIEW_PAGE_SIZE = int(os.getenv("STOCK_VIEW_PAGE_SIZE", "200"))
+STOCK_SEARCH_FTS = os.getenv("STOCK_SEARCH_FTS", "1") == "1"
+# Đếm số dòng khớp khi tìm kiếm kho dừng ở giới hạn này (hiển thị "N+"), tránh đếm hết mọi kết quả.
+STOCK_SEARCH_COUNT_LIMIT = int(os.getenv("STOCK_SEARCH_COUNT_LIMIT", "10000"))
+
+# Dashboard tải từng phần qua JSON: số dòng mặc định mỗi trang (keymap, proxy, thống kê kho, danh sách website).
+DASHBOARD_PAGE_SIZE = int(os.getenv("DASHBOARD_PAGE_SIZE", "200"))
+
+# Cache keymap trong bộ nhớ: chu kỳ (giây) kiểm tra bộ đếm thế hệ trong DB
+# để nhận thay đổi do worker Gunicorn khác ghi.
+KEYMAP_CACHE_CHECK_INTERVAL = float(os.getenv("KEYMAP_CACHE_CHECK_INTERVAL", "1"))
+
+# Cache danh mục sản phẩm của nhà cung cấp (dùng cho /stock).
+# TTL tính bằng giây (0 = tắt cache, chỉ giữ single-flight), MAX = số provider tối đa giữ trong cache.
+CATALOG_CACHE_TTL = float(os.getenv("CATALOG_CACHE_TTL", "10"))
+CATALOG_CACHE_MAX = int(os.getenv("CATALOG_CACHE_MAX", "256"))
+
+# Hedging cho lệnh đọc danh mục (chỉ products.php, KHÔNG BAO GIỜ áp dụng cho buyProduct):
+# nếu lần gọi đầu chưa trả lời sau phân vị HEDGE_PERCENTILE của độ trễ gần đây thì gửi thêm
+# 1 request qua proxy sống khác và lấy kết quả về trước. Chưa đủ HEDGE_MIN_SAMPLES mẫu thì chờ DEFAULT_TIMEOUT/2.
+CATALOG_HEDGE = os.getenv("CATALOG_HEDGE", "0") == "1"
+CATALOG_HEDGE_PERCENTILE = float(os.getenv("CATALOG_HEDGE_PERCENTILE", "95"))
+CATALOG_HEDGE_MIN_SAMPLES = int(os.getenv("CATALOG_HEDGE_MIN_SAMPLES", "20"))
+CATALOG_HEDGE_WORKERS = int(os.getenv("CATALOG_HEDGE_WORKERS", "16"))
+
+# Endpoint /metrics (định dạng Prometheus text). METRICS_ENABLED=0 tắt toàn bộ việc thu thập.
+# Luôn yêu cầu xác thực: cookie admin, hoặc METRICS_TOKEN qua "Authorization: Bearer <token>" / ?token=.
+# Không đặt METRICS_TOKEN thì chỉ admin đã đăng nhập xem được, các request khác nhận 404.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# Profiling theo yêu cầu (mặc định tắt, bật qua trang admin /admin/profile hoặc biến môi trường).
+# PROFILE_ROUTE + PROFILE_REQUESTS: profile N request kế tiếp của route (vd. "/fetch") ngay từ lúc khởi động.
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_ROUTE = os.getenv("PROFILE_ROUTE", "")
+PROFILE_REQUESTS = int(os.getenv("PROFILE_REQUESTS", "0"))
+
+# Endpoint batch (/stock/batch, /fetch/batch): số key tối đa mỗi request và số lệnh gọi nhà cung cấp chạy song song.
+BATCH_MAX_KEYS = int(os.getenv("BATCH_MAX_KEYS", "500"))
+BATCH_UPSTREAM_CONCURRENCY = int(os.getenv("BATCH_UPSTREAM_CONCURRENCY", "8"))
+
+# Chế độ khởi động nhanh: nhận request ngay, chạy restore/tạo chỉ mục/quét proxy ở luồng nền.
+# Trong lúc đó /stock, /fetch trả 503 cho đến khi sẵn sàng (thay vì trả 0 / [] từ DB còn trống).
+FAST_BOOT = os.getenv("FAST_BOOT", "0") == "1"
+# Số lần thử lại restore lúc khởi động (vd. "database is locked"), cách nhau STARTUP_RESTORE_RETRY_DELAY giây (tăng dần).
+STARTUP_RESTORE_RETRIES = int(os.getenv("STARTUP_RESTORE_RETRIES", "3"))
+STARTUP_RESTORE_RETRY_DELAY = float(os.getenv("STARTUP_RESTORE_RETRY_DELAY", "5"))
 
 # Khởi tạo ứng dụng Flask.
 app = Flask(__name__)
@@ -58,14 +162,26 @@ CURRENT_PROXY_SET = {
 }
 CURRENT_PROXY_STRING = "" 
 
-# Khóa thread (Mutex) để tránh xung đột khi nhiều luồng cùng ghi vào Database.
-db_lock = threading.Lock()
-
 # Cờ kiểm soát trạng thái các luồng chạy ngầm.
 proxy_checker_started = False
 ping_service_started = False
 auto_backup_started = False
 
+# Kết quả lần backup gần nhất (thời gian chạy, dung lượng, số dòng).
+last_backup_info = {}
+
+# True khi bảng tìm kiếm FTS5 (local_stock_fts) dùng được, nếu không sẽ tìm bằng LIKE.
+stock_fts_available = False
+
+# Trạng thái khởi động: live = đã nhận request được, ready = restore & tạo chỉ mục đã xong thành công.
+startup_state = {
+    "phase": "booting",
+    "ready": False,
+    "error": None,
+    "live_seconds": None,
+    "ready_seconds": None,
+}
+
 
 # ==============================================================================
 # ==============================================================================
@@ -88,6 +204,100 @@ def get_vn_time():
     return vn_now.strftime("%Y-%m-%d %H:%M:%S")
 
 
+# --- ĐO LƯỜNG HIỆU NĂNG (METRICS) ---
+# Ngưỡng bucket (giây) dùng chung cho mọi histogram độ trễ.
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+_metrics_lock = threading.Lock()
+# (tên, nhãn) -> [số mẫu theo từng bucket (bucket cuối = +Inf)..., tổng giá trị]
+_metric_histograms = {}
+# (tên, nhãn) -> giá trị cộng dồn
+_metric_counters = {}
+
+def observe(name: str, value: float, **labels):
+    """Ghi 1 mẫu vào histogram (chi phí: 1 lần bisect + 1 lần lấy khóa)."""
+    if not METRICS_ENABLED:
+        return
+    key = (name, tuple(labels.items()))
+    idx = bisect_left(METRICS_BUCKETS, value)
+    with _metrics_lock:
+        hist = _metric_histograms.get(key)
+        if hist is None:
+            hist = _metric_histograms[key] = [0] * (len(METRICS_BUCKETS) + 1) + [0.0]
+        hist[idx] += 1
+        hist[-1] += value
+
+def inc_counter(name: str, amount: float = 1, **labels):
+    if not METRICS_ENABLED:
+        return
+    key = (name, tuple(labels.items()))
+    with _metrics_lock:
+        _metric_counters[key] = _metric_counters.get(key, 0) + amount
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    parts = []
+    for k, v in labels:
+        v = str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+def render_metrics(gauges: list) -> str:
+    """
+    Xuất histogram, counter và các giá trị đọc lúc scrape [(tên, nhãn, giá trị)] theo định dạng Prometheus text 0.0.4
+    (tên kết thúc bằng _total được khai báo là counter, còn lại là gauge).
+    """
+    with _metrics_lock:
+        histograms = [(k, list(v)) for k, v in _metric_histograms.items()]
+        counters = list(_metric_counters.items())
+
+    lines, typed = [], set()
+    def type_line(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), hist in sorted(histograms):
+        type_line(name, "histogram")
+        cumulative = 0
+        for le, n in zip(METRICS_BUCKETS + ("+Inf",), hist[:-1]):
+            cumulative += n
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {hist[-1]:.6f}")
+        lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+    for (name, labels), value in sorted(counters):
+        type_line(name, "counter")
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    # Mỗi họ metric phải liền 1 khối: gom theo tên (sắp xếp ổn định, giữ thứ tự nhãn trong họ)
+    for name, labels, value in sorted(gauges, key=lambda gauge: gauge[0]):
+        type_line(name, "counter" if name.endswith("_total") else "gauge")
+        lines.append(f"{name}{_format_labels(tuple(labels.items()))} {value}")
+    return "\n".join(lines) + "\n"
+
+class TimedLock:
+    """threading.Lock có đo thời gian chờ và thời gian giữ khóa (histogram lock_wait_seconds / lock_hold_seconds)."""
+
+    def __init__(self, name: str):
+        self._lock = threading.Lock()
+        self._name = name
+        self._acquired_at = 0.0
+
+    def __enter__(self):
+        started = time.perf_counter()
+        self._lock.acquire()
+        self._acquired_at = time.perf_counter()
+        observe("lock_wait_seconds", self._acquired_at - started, lock=self._name)
+        return self
+
+    def __exit__(self, *exc):
+        held = time.perf_counter() - self._acquired_at
+        self._lock.release()
+        observe("lock_hold_seconds", held, lock=self._name)
+
+# Khóa thread (Mutex) để tránh xung đột khi nhiều luồng cùng ghi vào Database.
+db_lock = TimedLock("db_lock")
+
+
 # ==============================================================================
 # ==============================================================================
 #
@@ -97,12 +307,55 @@ def get_vn_time():
 # ==============================================================================
 # ==============================================================================
 
-def db():
-    """Tạo kết nối mới đến Database SQLite."""
-    con = sqlite3.connect(DB)
-    con.row_factory = sqlite3.Row 
+# Pool kết nối: mỗi thread giữ 1 kết nối GHI và 1 kết nối ĐỌC, dùng lại suốt vòng đời thread.
+# Ghi kèm PID để worker Gunicorn sau khi fork không dùng lại kết nối của tiến trình cha.
+_db_local = threading.local()
+
+def _open_db(readonly: bool = False):
+    """Mở kết nối SQLite mới với các PRAGMA đã tinh chỉnh (WAL, busy_timeout, cache, mmap)."""
+    con = sqlite3.connect(DB, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+    con.row_factory = sqlite3.Row
+    con.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    if not readonly:
+        # WAL: người đọc không bị chặn bởi người ghi (chế độ này được lưu vĩnh viễn trong file DB)
+        con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    con.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    con.execute("PRAGMA temp_store=MEMORY")
+    if readonly:
+        con.execute("PRAGMA query_only=1")
     return con
 
+def _thread_db(kind: str):
+    pid = os.getpid()
+    if getattr(_db_local, "pid", None) != pid:
+        # Thread mới hoặc tiến trình vừa fork: bỏ kết nối cũ (không close vì thuộc tiến trình cha)
+        _db_local.pid = pid
+        _db_local.conns = {}
+    con = _db_local.conns.get(kind)
+    if con is None:
+        con = _open_db(readonly=(kind == "read"))
+        _db_local.conns[kind] = con
+    return con
+
+def db():
+    """Kết nối GHI đến Database SQLite (dùng lại theo thread)."""
+    return _thread_db("write")
+
+def db_read():
+    """Kết nối CHỈ ĐỌC (dùng lại theo thread), không bao giờ chờ người ghi nhờ WAL."""
+    return _thread_db("read")
+
+def close_thread_db():
+    """Đóng các kết nối của thread hiện tại (dùng khi thread kết thúc hoặc khi test)."""
+    conns = getattr(_db_local, "conns", None) or {}
+    if getattr(_db_local, "pid", None) == os.getpid():
+        for con in conns.values():
+            try: con.close()
+            except Exception: pass
+    _db_local.conns = {}
+
 def _ensure_col(con, table, col, decl):
     """Hàm phụ trợ để đảm bảo một cột tồn tại trong bảng."""
     try:
@@ -111,10 +364,272 @@ def _ensure_col(con, table, col, decl):
     except Exception:
         pass
 
+# Bộ chỉ mục phụ (secondary index) có đánh số phiên bản.
+# Khi thay đổi danh sách này, tăng INDEX_VERSION để init_db tạo lại trên DB đang chạy.
+INDEX_VERSION = 3
+DB_INDEXES = [
+    ("idx_local_stock_group_id", "local_stock(group_name, id)"),
+    ("idx_local_stock_group_content", "local_stock(group_name, content)"),
+    ("idx_local_history_group_id", "local_history(group_name, id)"),
+    ("idx_keymaps_key_active", "keymaps(input_key, is_active)"),
+    ("idx_keymaps_group_provider_sku", "keymaps(group_name, provider_type, sku, id)"),
+    ("idx_proxies_live_latency_cover", "proxies(is_live DESC, latency, id, proxy_string)"),
+]
+# Chỉ mục của các phiên bản cũ, bị xóa khi nâng INDEX_VERSION.
+DB_OBSOLETE_INDEXES = ["idx_proxies_live_latency"]
+
+# Các khóa config do hệ thống tự quản lý, không ghi đè khi khôi phục từ file backup.
+INTERNAL_CONFIG_KEYS = {"index_version", "keymap_generation", "fts_built", "journal_version"}
+
+# Phiên bản bộ trigger nhật ký thay đổi (SQL của trigger nhúng JOURNAL_TABLES và INTERNAL_CONFIG_KEYS
+# lúc tạo). Tăng số này mỗi khi đổi 2 cấu hình trên để DB cũ được tạo lại trigger.
+JOURNAL_VERSION = 2
+
+# Các truy vấn nóng không được phép quét toàn bảng (kiểm tra bằng EXPLAIN QUERY PLAN).
+HOT_QUERIES = [
+    ("fetch_local_stock", "SELECT id FROM local_stock WHERE group_name=? ORDER BY id LIMIT ?", ("G", 1)),
+    ("get_local_stock_count", "SELECT cnt FROM local_stock_counts WHERE group_name=?", ("G",)),
+    ("admin_local_stock_view", "SELECT s.* FROM local_stock s WHERE s.group_name=? AND s.id>? ORDER BY s.id ASC LIMIT ?", ("G", 0, 1)),
+    ("admin_local_stock_view_prev", "SELECT s.* FROM local_stock s WHERE s.group_name=? AND s.id<? ORDER BY s.id DESC LIMIT ?", ("G", 0, 1)),
+    ("admin_local_stock_download", "SELECT id, content FROM local_stock WHERE group_name=? AND id>? ORDER BY id LIMIT ?", ("G", 0, 1)),
+    ("admin_local_history_view", "SELECT * FROM local_history WHERE group_name=? ORDER BY id DESC LIMIT 500", ("G",)),
+    ("admin_local_stock_dedup", "SELECT MIN(id) FROM local_stock WHERE group_name=? GROUP BY content", ("G",)),
+    ("find_map_by_key", "SELECT * FROM keymaps WHERE input_key=? AND is_active=1", ("K",)),
+    ("admin_api_keymap_groups", "SELECT group_name, provider_type, COUNT(*) FROM keymaps GROUP BY group_name, provider_type", ()),
+    ("admin_api_keymaps", "SELECT id, sku FROM keymaps WHERE group_name IS ? AND provider_type=? AND (sku, id) > (?, ?) ORDER BY sku, id LIMIT ?", ("G", "local", "", 0, 1)),
+    ("admin_api_proxies", "SELECT id, proxy_string, is_live, latency FROM proxies ORDER BY is_live DESC, latency, id LIMIT ? OFFSET ?", (1, 0)),
+    ("admin_api_local_stock_stats", "SELECT group_name, cnt FROM local_stock_counts WHERE group_name > ? ORDER BY group_name LIMIT ?", ("G", 1)),
+]
+
+# Truy vấn nóng chỉ có khi bật tìm kiếm FTS (bảng local_stock_fts tồn tại).
+HOT_QUERIES_FTS = [
+    ("admin_local_stock_search", """
+        SELECT s.* FROM local_stock_fts f JOIN local_stock s ON s.id = f.rowid
+        WHERE local_stock_fts MATCH ? AND s.group_name=? AND s.id>? ORDER BY s.id ASC LIMIT ?
+    """, ('"abc"', "G", 0, 1)),
+]
+
+def _ensure_indexes(con):
+    """Tạo bộ chỉ mục phụ nếu phiên bản lưu trong config cũ hơn INDEX_VERSION."""
+    row = con.execute("SELECT value FROM config WHERE key='index_version'").fetchone()
+    current = int(row['value']) if row and str(row['value']).isdigit() else 0
+    if current >= INDEX_VERSION:
+        return
+
+    print(f"INFO: Đang tạo chỉ mục Database (phiên bản {current} -> {INDEX_VERSION})...")
+    for name in DB_OBSOLETE_INDEXES:
+        con.execute(f"DROP INDEX IF EXISTS {name}")
+    for name, target in DB_INDEXES:
+        con.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+    con.execute("INSERT OR REPLACE INTO config (key, value) VALUES ('index_version', ?)", (str(INDEX_VERSION),))
+    con.execute("PRAGMA optimize")
+    con.commit()
+
+def check_query_plans(con) -> list:
+    """
+    Chạy EXPLAIN QUERY PLAN cho các truy vấn nóng.
+    Trả về danh sách (tên, chi tiết plan) của các bước quét không dùng chỉ mục phủ:
+    "SCAN t" (toàn bảng) và cả "SCAN t USING INDEX ..." (đi hết chỉ mục rồi tra từng dòng trong bảng).
+    Chỉ chấp nhận SEARCH, SCAN ... USING COVERING INDEX (chỉ đọc chỉ mục hẹp, không tra bảng), và bảng ảo (FTS5)
+    được truy cập qua ràng buộc ("VIRTUAL TABLE INDEX 0:=M1" = tra theo rowid + MATCH; "INDEX 0:" rỗng = quét hết).
+    """
+    problems = []
+    for name, sql, params in HOT_QUERIES + (HOT_QUERIES_FTS if stock_fts_available else []):
+        for plan_row in con.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall():
+            detail = plan_row[3]
+            if not detail.startswith("SCAN") or "USING COVERING INDEX" in detail:
+                continue
+            if "VIRTUAL TABLE INDEX" in detail and not detail.endswith(":"):
+                continue
+            problems.append((name, detail))
+    return problems
+
+def _create_keymap_generation_triggers(con):
+    for op in ("INSERT", "UPDATE", "DELETE"):
+        con.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_keymaps_generation_{op.lower()}
+            AFTER {op} ON keymaps
+            BEGIN
+                UPDATE config SET value = CAST(value AS INTEGER) + 1 WHERE key = 'keymap_generation';
+            END
+        """)
+
+def _drop_triggers(con, prefix: str):
+    """Gỡ mọi trigger có tên bắt đầu bằng prefix (dùng khi nạp dữ liệu hàng loạt)."""
+    names = [r[0] for r in con.execute("SELECT name FROM sqlite_master WHERE type='trigger' AND name LIKE ?", (prefix + "%",))]
+    for name in names:
+        con.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+def _create_local_stock_count_triggers(con):
+    """Trigger giữ bảng local_stock_counts khớp với local_stock ở MỌI đường ghi (thêm, lấy, quét trùng, xóa, restore)."""
+    con.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_local_stock_count_insert
+        AFTER INSERT ON local_stock
+        BEGIN
+            INSERT INTO local_stock_counts(group_name, cnt) VALUES (new.group_name, 1)
+            ON CONFLICT(group_name) DO UPDATE SET cnt = cnt + 1;
+        END
+    """)
+    con.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_local_stock_count_delete
+        AFTER DELETE ON local_stock
+        BEGIN
+            UPDATE local_stock_counts SET cnt = cnt - 1 WHERE group_name = old.group_name;
+            DELETE FROM local_stock_counts WHERE group_name = old.group_name AND cnt <= 0;
+        END
+    """)
+    con.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_local_stock_count_update
+        AFTER UPDATE OF group_name ON local_stock
+        WHEN old.group_name IS NOT new.group_name
+        BEGIN
+            UPDATE local_stock_counts SET cnt = cnt - 1 WHERE group_name = old.group_name;
+            DELETE FROM local_stock_counts WHERE group_name = old.group_name AND cnt <= 0;
+            INSERT INTO local_stock_counts(group_name, cnt) VALUES (new.group_name, 1)
+            ON CONFLICT(group_name) DO UPDATE SET cnt = cnt + 1;
+        END
+    """)
+
+def _setup_local_stock_fts(con) -> bool:
+    """
+    Tạo bảng FTS5 (tokenizer trigram, hỗ trợ tìm chuỗi con như LIKE '%q%') làm chỉ mục bóng cho local_stock.content,
+    kèm trigger đồng bộ ở mọi đường thêm/lấy/xóa. Trả về False nếu SQLite không hỗ trợ FTS5/trigram.
+    """
+    if not STOCK_SEARCH_FTS:
+        # Tắt FTS: gỡ trigger để các lệnh ghi không phải trả thêm chi phí
+        for name in ("trg_local_stock_fts_insert", "trg_local_stock_fts_delete", "trg_local_stock_fts_update"):
+            con.execute(f"DROP TRIGGER IF EXISTS {name}")
+        con.execute("DROP TABLE IF EXISTS local_stock_fts")
+        # Bật lại FTS sau này phải dựng lại chỉ mục từ đầu
+        con.execute("DELETE FROM config WHERE key='fts_built'")
+        return False
+    try:
+        con.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS local_stock_fts
+            USING fts5(content, content='local_stock', content_rowid='id', tokenize='trigram')
+        """)
+    except sqlite3.OperationalError as e:
+        print(f"WARNING: SQLite không hỗ trợ FTS5 trigram ({e}). Tìm kiếm kho sẽ dùng LIKE.")
+        return False
+
+    con.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_local_stock_fts_insert
+        AFTER INSERT ON local_stock
+        BEGIN
+            INSERT INTO local_stock_fts(rowid, content) VALUES (new.id, new.content);
+        END
+    """)
+    con.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_local_stock_fts_delete
+        AFTER DELETE ON local_stock
+        BEGIN
+            INSERT INTO local_stock_fts(local_stock_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END
+    """)
+    con.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_local_stock_fts_update
+        AFTER UPDATE OF content ON local_stock
+        BEGIN
+            INSERT INTO local_stock_fts(local_stock_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO local_stock_fts(rowid, content) VALUES (new.id, new.content);
+        END
+    """)
+    return True
+
+def rebuild_local_stock_fts(con):
+    """Dựng lại chỉ mục FTS từ local_stock (chạy 1 lần khi bảng FTS mới được tạo trên DB đã có dữ liệu)."""
+    con.execute("INSERT INTO local_stock_fts(local_stock_fts) VALUES ('rebuild')")
+    con.execute("INSERT OR REPLACE INTO config (key, value) VALUES ('fts_built', '1')")
+
+def check_local_stock_counts(con) -> list:
+    """So sánh bảng đếm với COUNT(*) thực tế. Trả về [(group, số lưu, số thực)] của các nhóm lệch."""
+    rows = con.execute("""
+        SELECT g.group_name, IFNULL(c.cnt, 0) AS stored, IFNULL(a.cnt, 0) AS actual
+        FROM (SELECT group_name FROM local_stock_counts
+              UNION SELECT DISTINCT group_name FROM local_stock) g
+        LEFT JOIN local_stock_counts c ON c.group_name = g.group_name
+        LEFT JOIN (SELECT group_name, COUNT(*) AS cnt FROM local_stock GROUP BY group_name) a
+               ON a.group_name = g.group_name
+        WHERE IFNULL(c.cnt, 0) != IFNULL(a.cnt, 0)
+    """).fetchall()
+    return [(r['group_name'], r['stored'], r['actual']) for r in rows]
+
+def rebuild_local_stock_counts(con):
+    """Dựng lại bảng đếm từ đầu bằng COUNT(*) trên local_stock."""
+    con.execute("DELETE FROM local_stock_counts")
+    con.execute("""
+        INSERT INTO local_stock_counts(group_name, cnt)
+        SELECT group_name, COUNT(*) FROM local_stock GROUP BY group_name
+    """)
+
+# Cột của từng bảng được ghi vào nhật ký thay đổi (dùng cho trigger và khi phát lại delta).
+JOURNAL_TABLES = {
+    "keymaps": ["id", "sku", "input_key", "product_id", "is_active", "group_name", "provider_type", "base_url", "api_key"],
+    "proxies": ["id", "proxy_string", "is_live", "latency", "last_checked"],
+    "local_stock": ["id", "group_name", "content", "added_at"],
+}
+
+def _setup_change_journal(con):
+    """
+    Tạo bảng change_log và trigger ghi lại thêm/sửa/xóa trên keymaps, proxies, config, local_stock.
+    op 'I' = ghi (thêm hoặc thay thế cả dòng), op 'D' = xóa. Trạng thái sống/chết của proxy không được ghi.
+    """
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS change_log(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tbl TEXT NOT NULL,
+            op TEXT NOT NULL,
+            row_key TEXT NOT NULL,
+            data TEXT
+        )
+    """)
+    # Trigger cũ (phiên bản khác) nhúng danh sách cột/khóa cũ: gỡ hết để tạo lại bên dưới
+    row = con.execute("SELECT value FROM config WHERE key='journal_version'").fetchone()
+    if not row or row['value'] != str(JOURNAL_VERSION):
+        _drop_triggers(con, "trg_journal_")
+        con.execute("INSERT OR REPLACE INTO config (key, value) VALUES ('journal_version', ?)", (str(JOURNAL_VERSION),))
+
+    trigger_names = []
+    for tbl, cols in JOURNAL_TABLES.items():
+        new_json = "json_object(" + ", ".join(f"'{c}', new.{c}" for c in cols) + ")"
+        events = [("insert", "INSERT", "'I'", "new.id", new_json), ("delete", "DELETE", "'D'", "old.id", "NULL")]
+        if tbl == "keymaps":
+            events.append(("update", "UPDATE", "'I'", "new.id", new_json))
+        for suffix, event, op, row_key, data in events:
+            name = f"trg_journal_{tbl}_{suffix}"
+            trigger_names.append((name, f"""
+                CREATE TRIGGER IF NOT EXISTS {name}
+                AFTER {event} ON {tbl}
+                BEGIN
+                    INSERT INTO change_log(tbl, op, row_key, data) VALUES ('{tbl}', {op}, {row_key}, {data});
+                END
+            """))
+    # Config: bỏ qua các khóa hệ thống tự quản lý
+    internal = ", ".join(f"'{k}'" for k in sorted(INTERNAL_CONFIG_KEYS))
+    for suffix, event, op, ref, data in (("insert", "INSERT", "'I'", "new", "json_object('key', new.key, 'value', new.value)"),
+                                         ("update", "UPDATE", "'I'", "new", "json_object('key', new.key, 'value', new.value)"),
+                                         ("delete", "DELETE", "'D'", "old", "NULL")):
+        name = f"trg_journal_config_{suffix}"
+        trigger_names.append((name, f"""
+            CREATE TRIGGER IF NOT EXISTS {name}
+            AFTER {event} ON config
+            WHEN {ref}.key NOT IN ({internal})
+            BEGIN
+                INSERT INTO change_log(tbl, op, row_key, data) VALUES ('config', {op}, {ref}.key, {data});
+            END
+        """))
+
+    for name, sql in trigger_names:
+        if BACKUP_JOURNAL:
+            con.execute(sql)
+        else:
+            con.execute(f"DROP TRIGGER IF EXISTS {name}")
+
 def init_db():
     """
     Hàm khởi tạo Database quan trọng nhất.
     """
+    global stock_fts_available
     with db_lock:
         with db() as con:
             print(f"INFO: Đang kết nối và khởi tạo Database tại: {DB}")
@@ -172,6 +687,34 @@ def init_db():
                     fetched_at TEXT
                 )
             """)
+
+            # TẠO BẢNG ĐẾM TỒN KHO THEO NHÓM (được TRIGGER giữ chính xác)
+            counts_existed = con.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name='local_stock_counts'"
+            ).fetchone() is not None
+            con.execute("""
+                CREATE TABLE IF NOT EXISTS local_stock_counts(
+                    group_name TEXT PRIMARY KEY,
+                    cnt INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            _create_local_stock_count_triggers(con)
+            if not counts_existed:
+                rebuild_local_stock_counts(con)
+
+            # TIẾN ĐỘ NHẬP KHO (lưu trong DB để mọi worker Gunicorn đều đọc được)
+            con.execute("""
+                CREATE TABLE IF NOT EXISTS import_progress(
+                    group_name TEXT PRIMARY KEY,
+                    stats TEXT NOT NULL
+                )
+            """)
+
+            # NHẬT KÝ THAY ĐỔI CHO BACKUP GIA TĂNG
+            _setup_change_journal(con)
+
+            # TẠO CHỈ MỤC TÌM KIẾM FTS5 CHO NỘI DUNG KHO
+            stock_fts_available = _setup_local_stock_fts(con)
             
             # MIGRATION: Cập nhật cấu trúc bảng
             _ensure_col(con, "keymaps", "group_name", "TEXT")
@@ -190,61 +733,253 @@ def init_db():
             con.execute("INSERT OR IGNORE INTO config (key, value) VALUES (?, ?)", ("selected_proxy_string", ""))
             con.execute("INSERT OR IGNORE INTO config (key, value) VALUES (?, ?)", ("ping_url", ""))
             con.execute("INSERT OR IGNORE INTO config (key, value) VALUES (?, ?)", ("ping_interval", "300"))
+            con.execute("INSERT OR IGNORE INTO config (key, value) VALUES (?, ?)", ("keymap_generation", "0"))
+
+            # TRIGGER: Mọi thay đổi trên keymaps đều tăng bộ đếm thế hệ (để các worker biết mà nạp lại cache)
+            _create_keymap_generation_triggers(con)
             
             con.commit()
 
-            # LOGIC AUTO RESTORE (KHÔI PHỤC DỮ LIỆU TỰ ĐỘNG)
-            keymap_count = con.execute("SELECT COUNT(*) FROM keymaps").fetchone()[0]
-            
-            if keymap_count == 0:
-                print("WARNING: Database đang trống. Đang tìm kiếm file Backup bí mật...")
-                
-                if SECRET_BACKUP_FILE_PATH and os.path.exists(SECRET_BACKUP_FILE_PATH):
-                    try:
-                        with open(SECRET_BACKUP_FILE_PATH, 'r', encoding='utf-8') as f:
-                            data = json.load(f)
-                        
-                        keymaps_to_import = []
-                        config_to_import = {}
-                        proxies_to_import = []
-                        local_stock_to_import = []
-
-                        # Kiểm tra định dạng file backup
-                        if isinstance(data, list):
-                            keymaps_to_import = data
-                        elif isinstance(data, dict):
-                            keymaps_to_import = data.get('keymaps', [])
-                            config_to_import = data.get('config', {})
-                            proxies_to_import = data.get('proxies', [])
-                            local_stock_to_import = data.get('local_stock', [])
-
-                        # Restore Keymaps
-                        for item in keymaps_to_import:
-                            con.execute("""
-                                INSERT OR IGNORE INTO keymaps(sku, input_key, product_id, is_active, group_name, provider_type, base_url, api_key) 
-                                VALUES(?,?,?,?,?,?,?,?)
-                            """, (item.get('sku'), item.get('input_key'), item.get('product_id'), item.get('is_active', 1), item.get('group_name', item.get('base_url', 'DEFAULT')), item.get('provider_type', 'mail72h'), item.get('base_url'), item.get('api_key')))
-
-                        # Restore Config
-                        for key, value in config_to_import.items():
-                            con.execute("INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)", (key, str(value)))
-                        
-                        # Restore Proxies
-                        for item in proxies_to_import:
-                            con.execute("INSERT OR IGNORE INTO proxies (proxy_string, is_live, latency, last_checked) VALUES (?, ?, ?, ?)", (item.get('proxy_string'), item.get('is_live', 0), item.get('latency', 9999.0), get_vn_time()))
-                            
-                        # Restore Local Stock
-                        for item in local_stock_to_import:
-                            con.execute("INSERT INTO local_stock (group_name, content, added_at) VALUES (?, ?, ?)", (item.get('group_name'), item.get('content'), item.get('added_at')))
-                        
-                        con.commit()
-                        print(f"SUCCESS: Đã khôi phục dữ liệu thành công từ Secret File!")
-                    except Exception as e:
-                        print(f"ERROR: Khôi phục thất bại. Lỗi chi tiết: {e}")
-                else:
-                    print(f"ERROR: Không tìm thấy file backup tại {SECRET_BACKUP_FILE_PATH}")
-            else:
-                 print("INFO: Database đã có dữ liệu. Bỏ qua bước khôi phục tự động.")
+def ensure_db_indexes():
+    """Tạo chỉ mục phụ / chỉ mục FTS (nếu cần) và cảnh báo các truy vấn nóng đang quét toàn bảng."""
+    with db_lock:
+        with db() as con:
+            _ensure_indexes(con)
+            if stock_fts_available:
+                row = con.execute("SELECT value FROM config WHERE key='fts_built'").fetchone()
+                if not row or row['value'] != '1':
+                    print("INFO: Đang dựng chỉ mục tìm kiếm FTS cho kho hàng...")
+                    rebuild_local_stock_fts(con)
+            for name, detail in check_query_plans(con):
+                print(f"WARNING: Truy vấn '{name}' đang quét không qua chỉ mục phủ: {detail}")
+
+def iter_backup_items(f, chunk_size: int = 1 << 20):
+    """
+    Đọc file backup JSON dạng stream (không nạp cả file vào RAM).
+    Sinh ra (tên mục, giá trị): phần tử của các mảng (keymaps, proxies, local_stock) được sinh từng cái một,
+    các mục khác (config, generated_at, journal_seq...) được sinh nguyên khối.
+    File dạng list kiểu cũ được coi là danh sách keymaps.
+    """
+    decoder = json.JSONDecoder()
+    st = {"buf": "", "pos": 0, "eof": False}
+
+    def fill() -> bool:
+        if st["eof"]:
+            return False
+        data = f.read(chunk_size)
+        st["buf"] = st["buf"][st["pos"]:] + data
+        st["pos"] = 0
+        if not data:
+            st["eof"] = True
+        return bool(data)
+
+    def peek() -> str:
+        while True:
+            buf, pos = st["buf"], st["pos"]
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            st["pos"] = pos
+            if pos < len(buf):
+                return buf[pos]
+            if not fill():
+                return ""
+
+    def take(ch: str):
+        got = peek()
+        if got != ch:
+            raise ValueError(f"File backup không hợp lệ: cần '{ch}' nhưng gặp '{got or 'EOF'}'.")
+        st["pos"] += 1
+
+    def value():
+        peek()
+        while True:
+            try:
+                val, end = decoder.raw_decode(st["buf"], st["pos"])
+                # Giá trị chạm cuối buffer (vd. số) có thể còn tiếp ở chunk sau
+                if end < len(st["buf"]) or st["eof"]:
+                    st["pos"] = end
+                    return val
+            except json.JSONDecodeError:
+                if st["eof"]:
+                    raise
+            fill()
+
+    def items(name: str):
+        take("[")
+        if peek() == "]":
+            st["pos"] += 1
+            return
+        while True:
+            yield name, value()
+            if peek() == ",":
+                st["pos"] += 1
+                continue
+            take("]")
+            return
+
+    if peek() == "[":
+        yield from items("keymaps")
+        return
+    take("{")
+    if peek() == "}":
+        return
+    while True:
+        key = value()
+        take(":")
+        if peek() == "[":
+            yield from items(key)
+        else:
+            yield key, value()
+        if peek() == ",":
+            st["pos"] += 1
+            continue
+        take("}")
+        return
+
+# Câu lệnh nạp cho từng bảng khi restore; id được giữ nguyên khi restore thay thế toàn bộ.
+# Ngữ nghĩa từng kiểu restore (giữ đúng hành vi của các đường restore trước đây):
+# - "upload": file tải lên trang admin thay toàn bộ dữ liệu; cấp id mới, keymap trùng input_key làm hỏng cả lần restore
+#   (rollback, dữ liệu cũ giữ nguyên), proxy về trạng thái chưa kiểm tra (is_live=0, latency=9999).
+# - "secret": file bí mật nạp vào DB trống lúc khởi động; cấp id mới, keymap trùng bị bỏ qua,
+#   keymap không có group_name lấy base_url / 'DEFAULT', giữ trạng thái proxy trong file.
+# - "chain": bản đầy đủ của chuỗi backup; thay toàn bộ dữ liệu và giữ nguyên id để phát lại delta.
+RESTORE_MODES = {
+    "upload": {"replace": True, "keep_ids": False, "keymaps": "INSERT", "proxies": "INSERT OR IGNORE"},
+    "secret": {"replace": False, "keep_ids": False, "keymaps": "INSERT OR IGNORE", "proxies": "INSERT OR IGNORE"},
+    "chain": {"replace": True, "keep_ids": True, "keymaps": "INSERT", "proxies": "INSERT"},
+}
+
+RESTORE_COLUMNS = {
+    "keymaps": ["sku", "input_key", "product_id", "is_active", "group_name", "provider_type", "base_url", "api_key"],
+    "proxies": ["proxy_string", "is_live", "latency", "last_checked"],
+    "local_stock": ["group_name", "content", "added_at"],
+}
+
+def _restore_sql(tbl: str, mode: str) -> str:
+    opts = RESTORE_MODES[mode]
+    cols = (["id"] if opts["keep_ids"] else []) + RESTORE_COLUMNS[tbl]
+    return f"{opts.get(tbl, 'INSERT')} INTO {tbl}({', '.join(cols)}) VALUES({', '.join(['?'] * len(cols))})"
+
+def _restore_row(tbl: str, item: dict, mode: str, now: str) -> tuple:
+    head = (item.get('id'),) if RESTORE_MODES[mode]["keep_ids"] else ()
+    if tbl == "keymaps":
+        group_name = item.get('group_name', item.get('base_url', 'DEFAULT')) if mode == "secret" else item.get('group_name')
+        return head + (item.get('sku'), item.get('input_key'), item.get('product_id'), item.get('is_active', 1),
+                       group_name, item.get('provider_type') or 'mail72h', item.get('base_url'), item.get('api_key'))
+    if tbl == "proxies":
+        if mode == "upload":
+            return head + (item.get('proxy_string'), 0, 9999.0, now)
+        return head + (item.get('proxy_string'), item.get('is_live', 0), item.get('latency', 9999.0), now)
+    return head + (item.get('group_name'), item.get('content'), item.get('added_at'))
+
+def restore_backup_stream(f, mode: str = "upload", after_load=None) -> dict:
+    """
+    Nạp file backup (đọc stream) vào DB theo ngữ nghĩa của mode (xem RESTORE_MODES), trong 1 transaction duy nhất.
+    - Trong lúc nạp: gỡ chỉ mục phụ và các trigger (đếm tồn, FTS, nhật ký, thế hệ keymap),
+      chèn bằng executemany theo lô RESTORE_BATCH_SIZE, sau đó tạo lại chỉ mục,
+      dựng lại bảng đếm/FTS 1 lần và bật lại trigger.
+    - after_load(con): hàm tùy chọn chạy ngay sau khi nạp, trong cùng transaction (vd. phát lại delta).
+    Lỗi ở bất kỳ bước nào (file hỏng, key trùng...) sẽ rollback, DB giữ nguyên trạng thái cũ (kể cả chỉ mục/trigger).
+    """
+    opts = RESTORE_MODES[mode]
+    started = time.time()
+    now = get_vn_time()
+    stats = {"keymaps": 0, "proxies": 0, "local_stock": 0, "config": 0}
+    batches = {tbl: [] for tbl in RESTORE_COLUMNS}
+    sql = {tbl: _restore_sql(tbl, mode) for tbl in RESTORE_COLUMNS}
+
+    def flush(con, tbl):
+        if batches[tbl]:
+            con.executemany(sql[tbl], batches[tbl])
+            stats[tbl] += len(batches[tbl])
+            batches[tbl].clear()
+
+    with db_lock:
+        con = db()
+        if con.in_transaction:
+            con.commit()
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            for prefix in ("trg_local_stock_count_", "trg_local_stock_fts_", "trg_journal_", "trg_keymaps_generation_"):
+                _drop_triggers(con, prefix)
+            for name, _ in DB_INDEXES:
+                con.execute(f"DROP INDEX IF EXISTS {name}")
+            if opts["replace"]:
+                for tbl in RESTORE_COLUMNS:
+                    con.execute(f"DELETE FROM {tbl}")
+
+            for section, item in iter_backup_items(f):
+                if section in batches and isinstance(item, dict):
+                    batches[section].append(_restore_row(section, item, mode, now))
+                    if len(batches[section]) >= RESTORE_BATCH_SIZE:
+                        flush(con, section)
+                elif section == "config" and isinstance(item, dict):
+                    rows = [(k, str(v)) for k, v in item.items() if k not in INTERNAL_CONFIG_KEYS]
+                    con.executemany("INSERT OR REPLACE INTO config(key, value) VALUES(?, ?)", rows)
+                    stats["config"] += len(rows)
+            for tbl in RESTORE_COLUMNS:
+                flush(con, tbl)
+            loaded_at = time.time()
+
+            if after_load:
+                after_load(con)
+
+            for name, target in DB_INDEXES:
+                con.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+            con.execute("INSERT OR REPLACE INTO config (key, value) VALUES ('index_version', ?)", (str(INDEX_VERSION),))
+            rebuild_local_stock_counts(con)
+            _create_local_stock_count_triggers(con)
+            if stock_fts_available:
+                rebuild_local_stock_fts(con)
+                _setup_local_stock_fts(con)
+            con.execute("DELETE FROM change_log")
+            _setup_change_journal(con)
+            _create_keymap_generation_triggers(con)
+            con.execute("UPDATE config SET value = CAST(value AS INTEGER) + 1 WHERE key = 'keymap_generation'")
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+
+    rows = stats["keymaps"] + stats["proxies"] + stats["local_stock"]
+    elapsed = time.time() - started
+    stats.update({
+        "rows": rows,
+        "load_seconds": round(loaded_at - started, 3),
+        "seconds": round(elapsed, 3),
+        "rows_per_sec": int(rows / elapsed) if elapsed > 0 else rows,
+    })
+    print(f"INFO: Restore {rows} dòng trong {stats['seconds']}s ({stats['rows_per_sec']} dòng/s, "
+          f"nạp {stats['load_seconds']}s, dựng chỉ mục {round(elapsed - (loaded_at - started), 3)}s).")
+    return stats
+
+def open_backup_file(path: str):
+    """Mở file backup ở chế độ text, tự nhận dạng .gz."""
+    return (gzip.open if path.endswith(".gz") else open)(path, 'rt', encoding='utf-8')
+
+def auto_restore_if_empty():
+    """Khôi phục dữ liệu từ Secret File khi Database còn trống."""
+    # LOGIC AUTO RESTORE (KHÔI PHỤC DỮ LIỆU TỰ ĐỘNG)
+    with db_read() as con:
+        keymap_count = con.execute("SELECT COUNT(*) FROM keymaps").fetchone()[0]
+
+    if keymap_count == 0:
+        print("WARNING: Database đang trống. Đang tìm kiếm file Backup bí mật...")
+
+        if SECRET_BACKUP_FILE_PATH and os.path.exists(SECRET_BACKUP_FILE_PATH):
+            try:
+                with open_backup_file(SECRET_BACKUP_FILE_PATH) as f:
+                    stats = restore_backup_stream(f, mode="secret")
+                reset_backup_chain()
+                print(f"SUCCESS: Đã khôi phục dữ liệu thành công từ Secret File! "
+                      f"({stats['keymaps']} keymap, {stats['proxies']} proxy, {stats['local_stock']} dòng kho)")
+            except Exception as e:
+                print(f"ERROR: Khôi phục thất bại. Lỗi chi tiết: {e}")
+                raise
+        else:
+            print(f"ERROR: Không tìm thấy file backup tại {SECRET_BACKUP_FILE_PATH}")
+    else:
+         print("INFO: Database đã có dữ liệu. Bỏ qua bước khôi phục tự động.")
 
 
 # ==============================================================================
@@ -274,6 +1009,162 @@ def format_proxy_url(proxy_string: str) -> dict:
         
     return {"http": formatted_proxy, "https": formatted_proxy}
 
+# --- POOL HTTP SESSION (KEEP-ALIVE) ---
+# Key: (scheme://host, proxy_string) -> requests.Session
+_http_sessions = OrderedDict()
+_http_sessions_lock = threading.Lock()
+# Session riêng cho lượt kiểm tra generate_204: proxy_string -> requests.Session (ngoài LRU ở trên)
+_probe_sessions = {}
+_live_route_count = 0
+
+def _new_http_session(proxy_string: str) -> requests.Session:
+    sess = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_MAXSIZE)
+    sess.mount("http://", adapter)
+    sess.mount("https://", adapter)
+    sess.proxies.update({k: v for k, v in format_proxy_url(proxy_string).items() if v})
+    return sess
+
+def _http_pool_limit() -> int:
+    """Số Session tối đa: đủ cho mọi cặp (host, proxy sống + proxy hiện tại), tối thiểu HTTP_POOL_MAX_SESSIONS."""
+    hosts = len({k[0] for k in _http_sessions})
+    return max(HTTP_POOL_MAX_SESSIONS, hosts * (_live_route_count + 1))
+
+def get_http_session(url: str, proxy_string: str = None) -> requests.Session:
+    """
+    Lấy Session keep-alive cho host của URL và proxy tương ứng (mặc định: proxy đang dùng).
+    Tái sử dụng kết nối TCP/TLS thay vì bắt tay lại qua proxy ở mỗi request.
+    """
+    if proxy_string is None:
+        proxy_string = CURRENT_PROXY_STRING
+    parts = urlsplit(url)
+    pool_key = (f"{parts.scheme}://{parts.netloc}", proxy_string or "")
+
+    with _http_sessions_lock:
+        sess = _http_sessions.get(pool_key)
+        if sess is not None:
+            _http_sessions.move_to_end(pool_key)
+            return sess
+
+        sess = _http_sessions[pool_key] = _new_http_session(proxy_string)
+
+        # Vượt giới hạn: bỏ Session ít dùng nhất khỏi pool. Không gọi close() vì luồng khác có thể đang
+        # dùng nó giữa chừng; kết nối được giải phóng khi request cuối cùng giữ Session kết thúc.
+        limit = _http_pool_limit()
+        while len(_http_sessions) > limit:
+            _http_sessions.popitem(last=False)
+        return sess
+
+def get_probe_session(proxy_string: str) -> requests.Session:
+    """Session cho lượt kiểm tra proxy: mỗi proxy 1 Session, không chiếm chỗ của Session định tuyến."""
+    with _http_sessions_lock:
+        sess = _probe_sessions.get(proxy_string)
+        if sess is None:
+            sess = _probe_sessions[proxy_string] = _new_http_session(proxy_string)
+        return sess
+
+def close_http_sessions(proxy_string: str = None):
+    """Bỏ các Session đi qua proxy chỉ định khỏi pool (None = tất cả); request đang chạy vẫn dùng nốt Session cũ."""
+    with _http_sessions_lock:
+        keys = [k for k in _http_sessions if proxy_string is None or k[1] == proxy_string]
+        for k in keys:
+            del _http_sessions[k]
+        for k in [k for k in _probe_sessions if proxy_string is None or k == proxy_string]:
+            del _probe_sessions[k]
+
+# --- ĐỊNH TUYẾN NHIỀU PROXY (EWMA ĐỘ TRỄ & TỈ LỆ LỖI) ---
+# proxy_string -> {"live", "latency" (giây, EWMA), "error_rate" (0..1, EWMA), "requests", "errors"}
+_proxy_routes = {}
+_proxy_routes_lock = threading.Lock()
+
+def refresh_proxy_routes():
+    """Đồng bộ danh sách proxy định tuyến với bảng proxies (sau mỗi lượt quét, khi thêm/xóa proxy)."""
+    global _live_route_count
+    rows = get_proxies_from_db()
+    with _proxy_routes_lock:
+        seen = set()
+        for row in rows:
+            proxy_string = row['proxy_string']
+            seen.add(proxy_string)
+            route = _proxy_routes.get(proxy_string)
+            if route is None:
+                route = _proxy_routes[proxy_string] = {"live": False, "latency": row['latency'] or 9999.0,
+                                                       "error_rate": 0.0, "requests": 0, "errors": 0}
+            route["live"] = bool(row['is_live'])
+            # Chưa có lưu lượng thật: lấy độ trễ của lần kiểm tra generate_204 làm giá trị khởi đầu
+            if route["requests"] == 0 and row['latency'] is not None:
+                route["latency"] = row['latency']
+        removed = [p for p in _proxy_routes if p not in seen]
+        for proxy_string in removed:
+            del _proxy_routes[proxy_string]
+        live_count = sum(1 for r in _proxy_routes.values() if r["live"])
+    _live_route_count = live_count
+    # Proxy đã bị xóa khỏi bảng: bỏ luôn Session định tuyến và Session kiểm tra của nó
+    for proxy_string in removed:
+        if proxy_string != CURRENT_PROXY_STRING:
+            close_http_sessions(proxy_string)
+
+def pick_proxy(exclude=()):
+    """
+    Chọn proxy cho 1 request ra ngoài: ngẫu nhiên có trọng số trong các proxy sống,
+    trọng số = (1 - tỉ lệ lỗi)^2 / độ trễ EWMA. Không có proxy sống thì dùng proxy hiện tại.
+    Trả về None khi proxy hiện tại cũng nằm trong exclude: không bao giờ tự rơi về kết nối trực tiếp.
+    """
+    if not PROXY_ROUTING:
+        return None if CURRENT_PROXY_STRING in exclude else CURRENT_PROXY_STRING
+    with _proxy_routes_lock:
+        candidates = [(p, r) for p, r in _proxy_routes.items() if r["live"] and p not in exclude]
+        if not candidates:
+            return None if CURRENT_PROXY_STRING in exclude else CURRENT_PROXY_STRING
+        weights = [max(1.0 - r["error_rate"], 0.05) ** 2 / max(r["latency"], 0.05) for _, r in candidates]
+    return random.choices([p for p, _ in candidates], weights=weights)[0]
+
+def record_proxy_result(proxy_string: str, elapsed: float, ok: bool, proxy_down: bool = False):
+    """Cập nhật EWMA độ trễ & tỉ lệ lỗi của proxy sau 1 request thật. proxy_down=True: loại proxy đến lượt kiểm tra sau."""
+    with _proxy_routes_lock:
+        route = _proxy_routes.get(proxy_string)
+        if route is None:
+            return
+        a = PROXY_EWMA_ALPHA
+        route["latency"] = elapsed if route["requests"] == 0 else (1 - a) * route["latency"] + a * elapsed
+        route["error_rate"] = (1 - a) * route["error_rate"] + a * (0.0 if ok else 1.0)
+        route["requests"] += 1
+        route["errors"] += 0 if ok else 1
+        if proxy_down:
+            route["live"] = False
+
+def routed_request(method: str, url: str, exclude=(), proxy_string: str = None, **kwargs) -> requests.Response:
+    """Gửi request ra ngoài qua proxy chỉ định (mặc định: do pick_proxy chọn) và ghi lại độ trễ/lỗi thực tế cho proxy đó."""
+    if proxy_string is None:
+        proxy_string = pick_proxy(exclude)
+    parts = urlsplit(url)
+    upstream = f"{parts.scheme}://{parts.netloc}"
+    if proxy_string is None:
+        # Đã loại hết proxy: báo lỗi proxy cho caller thay vì gửi thẳng (lộ IP máy chủ)
+        inc_counter("upstream_errors_total", base_url=upstream, kind="NoProxyLeft")
+        raise requests.exceptions.ProxyError("Không còn proxy nào để gửi request")
+    started = time.time()
+    try:
+        r = get_http_session(url, proxy_string).request(method, url, timeout=DEFAULT_TIMEOUT, **kwargs)
+    except requests.exceptions.RequestException as e:
+        elapsed = time.time() - started
+        record_proxy_result(proxy_string, elapsed, False, proxy_down=isinstance(e, requests.exceptions.ProxyError))
+        observe("upstream_request_duration_seconds", elapsed, base_url=upstream)
+        inc_counter("upstream_errors_total", base_url=upstream, kind=type(e).__name__)
+        raise
+    elapsed = time.time() - started
+    record_proxy_result(proxy_string, elapsed, r.status_code < 500)
+    observe("upstream_request_duration_seconds", elapsed, base_url=upstream)
+    if r.status_code >= 400:
+        inc_counter("upstream_errors_total", base_url=upstream, kind=f"http_{r.status_code}")
+    return r
+
+def get_proxy_route_stats() -> dict:
+    with _proxy_routes_lock:
+        routes = {p: {**r, "latency": round(r["latency"], 4), "error_rate": round(r["error_rate"], 4)}
+                  for p, r in _proxy_routes.items()}
+    return {"enabled": PROXY_ROUTING, "alpha": PROXY_EWMA_ALPHA, "current": CURRENT_PROXY_STRING, "routes": routes}
+
 def check_proxy_live(proxy_string: str) -> tuple:
     """Kiểm tra proxy sống hay chết."""
     formatted_proxies = format_proxy_url(proxy_string)
@@ -282,9 +1173,8 @@ def check_proxy_live(proxy_string: str) -> tuple:
 
     try:
         start_time = time.time()
-        requests.get("http://www.google.com/generate_204", 
-                     proxies=formatted_proxies, 
-                     timeout=DEFAULT_TIMEOUT * 2)
+        check_url = "http://www.google.com/generate_204"
+        get_probe_session(proxy_string).get(check_url, timeout=DEFAULT_TIMEOUT * 2)
         latency = time.time() - start_time
         return (1, latency)
     except Exception:
@@ -300,10 +1190,56 @@ def update_proxy_state(proxy_string: str, is_live: int, latency: float):
             """, (is_live, latency, get_vn_time(), proxy_string))
             con.commit()
 
-def get_proxies_from_db():
+def update_proxy_states_batch(results: list):
+    """Ghi kết quả kiểm tra [(proxy_string, is_live, latency)] trong 1 transaction."""
+    if not results:
+        return
+    now = get_vn_time()
     with db_lock:
         with db() as con:
-            return con.execute("SELECT * FROM proxies ORDER BY is_live DESC, latency ASC").fetchall()
+            con.executemany("""
+                UPDATE proxies SET is_live=?, latency=?, last_checked=?
+                WHERE proxy_string=?
+            """, [(is_live, latency, now, proxy_string) for proxy_string, is_live, latency in results])
+            con.commit()
+
+def run_proxy_sweep(proxy_strings: list, on_result=None) -> list:
+    """
+    Kiểm tra song song danh sách proxy (tối đa PROXY_CHECK_CONCURRENCY cùng lúc, trong PROXY_SWEEP_DEADLINE giây).
+    on_result(proxy_string, is_live, latency) được gọi ngay khi từng proxy có kết quả. Khi proxy đang dùng bị chết
+    (on_result sắp chuyển proxy), các kết quả đang chờ được ghi xuống DB trước để không chọn phải proxy vừa chết
+    trong lượt này; các trường hợp khác vẫn ghi 1 lần cuối lượt.
+    Proxy chưa kịp trả lời khi hết hạn được giữ nguyên trạng thái cũ.
+    """
+    if not proxy_strings:
+        return []
+
+    results = []
+    written = 0
+    executor = ThreadPoolExecutor(max_workers=max(1, min(PROXY_CHECK_CONCURRENCY, len(proxy_strings))))
+    futures = {executor.submit(check_proxy_live, p): p for p in proxy_strings}
+    try:
+        for fut in as_completed(futures, timeout=PROXY_SWEEP_DEADLINE):
+            proxy_string = futures[fut]
+            is_live, latency = fut.result()
+            results.append((proxy_string, is_live, latency))
+            if on_result:
+                if not is_live and proxy_string == CURRENT_PROXY_STRING:
+                    update_proxy_states_batch(results[written:])
+                    written = len(results)
+                on_result(proxy_string, is_live, latency)
+    except FuturesTimeoutError:
+        print(f"WARNING: Hết hạn quét proxy ({PROXY_SWEEP_DEADLINE}s), {len(proxy_strings) - len(results)} proxy chưa kiểm tra xong.")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    update_proxy_states_batch(results[written:])
+    refresh_proxy_routes()
+    return results
+
+def get_proxies_from_db():
+    with db_read() as con:
+        return con.execute("SELECT * FROM proxies ORDER BY is_live DESC, latency ASC").fetchall()
 
 def load_selected_proxy_from_db(con):
     row = con.execute("SELECT value FROM config WHERE key=?", ("selected_proxy_string",)).fetchone()
@@ -311,6 +1247,12 @@ def load_selected_proxy_from_db(con):
 
 def set_current_proxy_by_string(proxy_string: str):
     global CURRENT_PROXY_SET, CURRENT_PROXY_STRING
+    # Đổi proxy khi không định tuyến: proxy cũ không còn được dùng nên bỏ Session của nó khỏi pool.
+    # Khi định tuyến, pick_proxy vẫn chọn proxy cũ nếu nó còn sống nên giữ nguyên Session.
+    old_proxy_string = CURRENT_PROXY_STRING
+    if not PROXY_ROUTING and old_proxy_string and old_proxy_string != proxy_string:
+        close_http_sessions(old_proxy_string)
+
     if not proxy_string:
         CURRENT_PROXY_SET = {"http": None, "https": None}
         CURRENT_PROXY_STRING = ""
@@ -364,10 +1306,7 @@ def run_initial_proxy_scan_and_select():
     if not proxies:
         return
 
-    for row in proxies:
-        proxy_string = row['proxy_string']
-        is_live, latency = check_proxy_live(proxy_string)
-        update_proxy_state(proxy_string, is_live, latency)
+    run_proxy_sweep([row['proxy_string'] for row in proxies])
         
     with db_lock:
         with db() as con:
@@ -388,26 +1327,27 @@ def proxy_checker_loop():
     time.sleep(2) 
 
     while True:
+        loop_started = time.time()
         try:
             proxies = get_proxies_from_db()
-            current_proxy_still_live = False
-
-            for row in proxies:
-                proxy_string = row['proxy_string']
-                is_live, latency = check_proxy_live(proxy_string)
-                update_proxy_state(proxy_string, is_live, latency)
-                
-                if is_live and proxy_string == CURRENT_PROXY_STRING:
-                    current_proxy_still_live = True
-                
-                time.sleep(0.5) 
-
-            if CURRENT_PROXY_STRING and not current_proxy_still_live:
-                print(f"WARNING: Proxy hiện tại {CURRENT_PROXY_STRING} đã chết. Đang tìm proxy thay thế...")
+            proxy_strings = [row['proxy_string'] for row in proxies]
+
+            def on_result(proxy_string, is_live, latency):
+                # Chuyển proxy NGAY khi proxy đang dùng bị chết, không đợi hết lượt quét
+                if not is_live and proxy_string == CURRENT_PROXY_STRING:
+                    print(f"WARNING: Proxy hiện tại {CURRENT_PROXY_STRING} đã chết. Đang tìm proxy thay thế...")
+                    switch_to_next_live_proxy()
+
+            run_proxy_sweep(proxy_strings, on_result)
+
+            # Proxy đang dùng đã bị xóa khỏi danh sách
+            if CURRENT_PROXY_STRING and CURRENT_PROXY_STRING not in proxy_strings:
+                print(f"WARNING: Proxy hiện tại {CURRENT_PROXY_STRING} không còn trong danh sách. Đang tìm proxy thay thế...")
                 switch_to_next_live_proxy() 
             
         except Exception as e:
             print(f"PROXY_CHECKER_ERROR: {e}")
+        observe("background_loop_duration_seconds", time.time() - loop_started, loop="proxy_checker")
         
         time.sleep(PROXY_CHECK_INTERVAL)
 
@@ -426,17 +1366,19 @@ def ping_loop():
             target_url = ""
             interval = 300
             
-            with db() as con:
+            with db_read() as con:
                 r1 = con.execute("SELECT value FROM config WHERE key='ping_url'").fetchone()
                 r2 = con.execute("SELECT value FROM config WHERE key='ping_interval'").fetchone()
                 if r1: target_url = r1['value']
                 if r2: interval = int(r2['value'])
             
             if target_url and target_url.startswith("http"):
+                ping_started = time.time()
                 try:
-                    requests.get(target_url, timeout=10)
+                    get_http_session(target_url, "").get(target_url, timeout=10)
                 except Exception as e:
                     print(f"PING ERROR: {e}")
+                observe("background_loop_duration_seconds", time.time() - ping_started, loop="ping")
             
             if interval < 10: interval = 10 
             time.sleep(interval)
@@ -452,34 +1394,291 @@ def start_ping_service():
         t.start()
 
 # --- THREAD 3: AUTO BACKUP ---
+def get_auto_backup_path() -> str:
+    """Đường dẫn file backup tự động (thêm .gz khi bật nén)."""
+    return AUTO_BACKUP_FILE + (".gz" if AUTO_BACKUP_COMPRESS else "")
+
+def _write_json_rows(f, cursor) -> int:
+    """Ghi kết quả truy vấn ra mảng JSON từng dòng một, trả về số dòng."""
+    f.write("[")
+    count = 0
+    for row in cursor:
+        f.write(("," if count else "") + "\n  " + json.dumps(dict(row), ensure_ascii=False))
+        count += 1
+    f.write("\n]")
+    return count
+
 def perform_backup_to_file():
+    """Backup toàn bộ dữ liệu ra file JSON (giữ khóa chuỗi backup trong suốt quá trình)."""
+    with backup_chain_lock():
+        return _perform_backup_to_file_locked()
+
+def _perform_backup_to_file_locked():
+    """
+    Backup toàn bộ dữ liệu ra file JSON.
+    - Đọc trong 1 transaction đọc (snapshot nhất quán nhờ WAL), KHÔNG giữ db_lock nên không chặn lấy hàng.
+    - Ghi stream từng dòng (tùy chọn nén gzip) vào file tạm, rồi đổi tên nguyên tử đè lên file cũ.
+    """
+    started = time.time()
+    target = get_auto_backup_path()
+    tmp_path = None
     try:
-        with db_lock:
-            with db() as con:
-                keymaps = [dict(row) for row in con.execute("SELECT * FROM keymaps").fetchall()]
+        fd, tmp_path = tempfile.mkstemp(prefix=".auto_backup.", suffix=".tmp", dir=os.path.dirname(os.path.abspath(target)))
+        os.close(fd)
+        rows = 0
+        con = db_read()
+        con.execute("BEGIN")
+        try:
+            # Vị trí nhật ký thay đổi tại thời điểm snapshot (delta sau này bắt đầu từ đây)
+            seq_row = con.execute("SELECT seq FROM sqlite_sequence WHERE name='change_log'").fetchone()
+            journal_seq = seq_row['seq'] if seq_row else 0
+            opener = gzip.open if AUTO_BACKUP_COMPRESS else open
+            with opener(tmp_path, 'wt', encoding='utf-8') as f:
+                f.write('{\n"journal_seq": ' + str(journal_seq) + ',\n"keymaps": ')
+                rows += _write_json_rows(f, con.execute("SELECT * FROM keymaps"))
                 config = {row['key']: row['value'] for row in con.execute("SELECT key, value FROM config").fetchall()}
-                proxies = [dict(row) for row in con.execute("SELECT * FROM proxies").fetchall()]
-                local_stock = [dict(row) for row in con.execute("SELECT * FROM local_stock").fetchall()]
-
-        backup_data = {
-            "keymaps": keymaps,
-            "config": config,
-            "proxies": proxies,
-            "local_stock": local_stock,
-            "generated_at": get_vn_time()
-        }
-        
-        with open(AUTO_BACKUP_FILE, 'w', encoding='utf-8') as f:
-            json.dump(backup_data, f, ensure_ascii=False, indent=2)
-            
+                f.write(',\n"config": ' + json.dumps(config, ensure_ascii=False))
+                f.write(',\n"proxies": ')
+                rows += _write_json_rows(f, con.execute("SELECT * FROM proxies"))
+                f.write(',\n"local_stock": ')
+                rows += _write_json_rows(f, con.execute("SELECT * FROM local_stock"))
+                f.write(',\n"generated_at": ' + json.dumps(get_vn_time()) + '\n}\n')
+        finally:
+            con.commit()
+
+        # Đảm bảo dữ liệu đã xuống đĩa trước khi thay thế file cũ
+        with open(tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+
+        # Đổi tên nguyên tử: crash giữa chừng vẫn còn nguyên file backup cũ
+        os.replace(tmp_path, target)
+        tmp_path = None
+        _fsync_dir(target)
+
+        # Bắt đầu chuỗi backup mới: bản đầy đủ này + các delta kể từ journal_seq
+        _start_backup_chain(target, journal_seq)
+
+        last_backup_info.update({
+            "file": target,
+            "bytes": os.path.getsize(target),
+            "rows": rows,
+            "seconds": round(time.time() - started, 3),
+            "finished_at": get_vn_time(),
+            "error": None,
+        })
+        print(f"INFO: Backup xong {target}: {rows} dòng, {last_backup_info['bytes']} bytes trong {last_backup_info['seconds']}s.")
     except Exception as e:
+        last_backup_info.update({"error": str(e), "finished_at": get_vn_time()})
         print(f"AUTO BACKUP ERROR: {e}")
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return last_backup_info
+
+def _backup_manifest_path() -> str:
+    return os.path.join(BACKUP_DIR, "manifest.json")
+
+# Khóa chuỗi backup: mọi thao tác đọc-sửa-ghi manifest (backup đầy đủ, delta, reset) chạy tuần tự,
+# giữa các thread (threading.Lock) và giữa các worker Gunicorn (flock trên BACKUP_DIR/manifest.lock).
+_backup_chain_thread_lock = threading.Lock()
+
+@contextmanager
+def backup_chain_lock():
+    with _backup_chain_thread_lock:
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        with open(os.path.join(BACKUP_DIR, "manifest.lock"), "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+def _fsync_dir(path: str):
+    """fsync thư mục chứa path để lệnh đổi tên (os.replace) bền vững khi mất điện (bỏ qua nếu hệ điều hành không hỗ trợ)."""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try: os.fsync(fd)
+    except OSError: pass
+    finally: os.close(fd)
+
+def _atomic_write_text(path: str, text: str):
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp.", dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync_dir(path)
+
+def _remove_orphan_deltas(manifest: dict):
+    """Xóa file delta không có trong manifest (sót lại khi crash giữa lúc ghi delta và ghi manifest)."""
+    known = {d["file"] for d in manifest.get("deltas", [])}
+    for name in os.listdir(BACKUP_DIR):
+        if name.startswith("delta_") and name not in known:
+            try: os.remove(os.path.join(BACKUP_DIR, name))
+            except OSError: pass
+
+def load_backup_manifest():
+    """Đọc manifest của chuỗi backup (bản đầy đủ + delta). None nếu chưa có."""
+    try:
+        with open(_backup_manifest_path(), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _start_backup_chain(full_path: str, journal_seq: int):
+    """
+    Ghi manifest mới cho bản đầy đủ vừa tạo, xóa delta cũ và phần nhật ký đã nằm trong snapshot.
+    Gọi khi đang giữ backup_chain_lock; nhật ký chỉ bị xóa sau khi manifest mới đã xuống đĩa.
+    """
+    if not BACKUP_JOURNAL:
+        return
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    manifest = {
+        "full": os.path.abspath(full_path),
+        "full_seq": journal_seq,
+        "generated_at": get_vn_time(),
+        "deltas": [],
+    }
+    _atomic_write_text(_backup_manifest_path(), json.dumps(manifest, ensure_ascii=False, indent=2))
+    _remove_orphan_deltas(manifest)
+    with db() as con:
+        con.execute("DELETE FROM change_log WHERE id<=?", (journal_seq,))
+        con.commit()
+
+def reset_backup_chain():
+    """Gọi sau khi restore: dữ liệu đã thay đổi toàn bộ nên lần backup kế tiếp phải là bản đầy đủ."""
+    with backup_chain_lock():
+        _reset_backup_chain_locked()
+
+def _reset_backup_chain_locked():
+    try: os.remove(_backup_manifest_path())
+    except OSError: pass
+    with db() as con:
+        con.execute("DELETE FROM change_log")
+        con.commit()
+
+def perform_delta_backup():
+    """
+    Ghi các thay đổi kể từ lần backup trước (bản đầy đủ hoặc delta) ra 1 file delta JSON Lines nhỏ.
+    Nếu chưa có chuỗi backup hợp lệ thì tạo bản đầy đủ.
+    """
+    with backup_chain_lock():
+        manifest = load_backup_manifest()
+        if not BACKUP_JOURNAL or not manifest or not os.path.exists(manifest.get("full", "")):
+            return _perform_backup_to_file_locked()
+        _remove_orphan_deltas(manifest)
+        return _write_delta_locked(manifest)
+
+def _write_delta_locked(manifest: dict) -> dict:
+    """Xuất nhật ký sau delta cuối của manifest ra file delta, cập nhật manifest rồi mới xóa phần nhật ký đã ghi."""
+    started = time.time()
+    from_seq = manifest["deltas"][-1]["to_seq"] if manifest["deltas"] else manifest["full_seq"]
+    suffix = ".jsonl.gz" if AUTO_BACKUP_COMPRESS else ".jsonl"
+    fd, tmp_path = tempfile.mkstemp(prefix=".delta.", suffix=".tmp", dir=BACKUP_DIR)
+    os.close(fd)
+    try:
+        count, to_seq = 0, from_seq
+        opener = gzip.open if AUTO_BACKUP_COMPRESS else open
+        with opener(tmp_path, 'wt', encoding='utf-8') as f:
+            with db_read() as con:
+                for row in con.execute("SELECT id, tbl, op, row_key, data FROM change_log WHERE id>? ORDER BY id", (from_seq,)):
+                    f.write('{"seq": %d, "tbl": %s, "op": %s, "key": %s, "data": %s}\n' % (
+                        row['id'], json.dumps(row['tbl']), json.dumps(row['op']),
+                        json.dumps(row['row_key'], ensure_ascii=False), row['data'] or "null"))
+                    count, to_seq = count + 1, row['id']
+        if count == 0:
+            return {"delta": None, "rows": 0}
+        with open(tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+
+        name = f"delta_{from_seq:012d}_{to_seq:012d}{suffix}"
+        os.replace(tmp_path, os.path.join(BACKUP_DIR, name))
+        manifest["deltas"].append({"file": name, "from_seq": from_seq, "to_seq": to_seq, "rows": count, "generated_at": get_vn_time()})
+        _atomic_write_text(_backup_manifest_path(), json.dumps(manifest, ensure_ascii=False, indent=2))
+        # Manifest đã bền vững trên đĩa -> mới xóa phần nhật ký đã nằm trong delta
+        with db() as con:
+            con.execute("DELETE FROM change_log WHERE id<=?", (to_seq,))
+            con.commit()
+
+        info = {"delta": name, "rows": count, "bytes": os.path.getsize(os.path.join(BACKUP_DIR, name)),
+                "seconds": round(time.time() - started, 3), "finished_at": get_vn_time()}
+        last_backup_info["last_delta"] = info
+        print(f"INFO: Backup delta {name}: {count} thay đổi, {info['bytes']} bytes trong {info['seconds']}s.")
+        return info
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _apply_journal_entry(con, entry: dict):
+    """Phát lại 1 thay đổi từ file delta."""
+    tbl, op = entry["tbl"], entry["op"]
+    if tbl == "config":
+        if op == "I":
+            con.execute("INSERT OR REPLACE INTO config(key, value) VALUES(?, ?)", (entry["data"]["key"], entry["data"]["value"]))
+        else:
+            con.execute("DELETE FROM config WHERE key=?", (entry["key"],))
+        return
+    cols = JOURNAL_TABLES[tbl]
+    if op == "I":
+        con.execute(f"INSERT OR REPLACE INTO {tbl}({', '.join(cols)}) VALUES({', '.join(['?'] * len(cols))})",
+                    [entry["data"].get(c) for c in cols])
+    else:
+        con.execute(f"DELETE FROM {tbl} WHERE id=?", (int(entry["key"]),))
+
+def restore_backup_chain() -> dict:
+    """Khôi phục từ chuỗi backup: nạp bản đầy đủ (giữ nguyên id) rồi phát lại các delta theo thứ tự, trong cùng 1 transaction."""
+    with backup_chain_lock():
+        stats = _restore_backup_chain_locked()
+    invalidate_keymap_cache()
+    return stats
+
+def _restore_backup_chain_locked() -> dict:
+    manifest = load_backup_manifest()
+    if not manifest or not os.path.exists(manifest.get("full", "")):
+        raise ValueError("Chưa có chuỗi backup (manifest hoặc bản đầy đủ bị thiếu).")
+
+    full_path = manifest["full"]
+    stats = {"full": full_path, "deltas": 0, "changes": 0}
+
+    def replay_deltas(con):
+        expected_seq = manifest["full_seq"]
+        for d in manifest["deltas"]:
+            if d["from_seq"] != expected_seq:
+                raise ValueError(f"Chuỗi delta bị đứt tại {d['file']}.")
+            with open_backup_file(os.path.join(BACKUP_DIR, d["file"])) as f:
+                for line in f:
+                    if line.strip():
+                        _apply_journal_entry(con, json.loads(line))
+                        stats["changes"] += 1
+            expected_seq = d["to_seq"]
+            stats["deltas"] += 1
+
+    with open_backup_file(full_path) as f:
+        stats.update(restore_backup_stream(f, mode="chain", after_load=replay_deltas))
+
+    _reset_backup_chain_locked()
+    return stats
 
 def auto_backup_loop():
-    print("INFO: Auto Backup Service đã bắt đầu (Chu kỳ: 60 phút).")
+    print(f"INFO: Auto Backup Service đã bắt đầu (Chu kỳ: 60 phút, bản đầy đủ mỗi {AUTO_BACKUP_FULL_EVERY} lần).")
+    run_count = 0
     while True:
         time.sleep(3600) 
-        perform_backup_to_file()
+        loop_started = time.time()
+        try:
+            if not BACKUP_JOURNAL or run_count % max(AUTO_BACKUP_FULL_EVERY, 1) == 0:
+                perform_backup_to_file()
+            else:
+                perform_delta_backup()
+        except Exception as e:
+            print(f"AUTO BACKUP ERROR: {e}")
+        observe("background_loop_duration_seconds", time.time() - loop_started, loop="auto_backup")
+        run_count += 1
 
 def start_auto_backup():
     global auto_backup_started
@@ -499,9 +1698,112 @@ def start_auto_backup():
 
 # --- 1. XỬ LÝ LOCAL STOCK (KHO THỦ CÔNG) ---
 def get_local_stock_count(group_name):
+    with db_read() as con:
+        row = con.execute("SELECT cnt FROM local_stock_counts WHERE group_name=?", (group_name,)).fetchone()
+    return row['cnt'] if row else 0
+
+def iter_upload_lines(file_storage):
+    """Đọc file upload từng dòng một (không nạp toàn bộ file vào RAM), nhận mọi kiểu xuống dòng (\n, \r\n, \r)."""
+    yield from io.TextIOWrapper(file_storage.stream, encoding='utf-8', errors='ignore', newline=None)
+
+def _save_import_progress(stats: dict):
+    """Ghi tiến độ nhập kho của nhóm vào bảng import_progress (đọc lại được từ worker khác)."""
     with db() as con:
-        count = con.execute("SELECT COUNT(*) FROM local_stock WHERE group_name=?", (group_name,)).fetchone()[0]
-    return count
+        con.execute("INSERT OR REPLACE INTO import_progress(group_name, stats) VALUES(?, ?)",
+                    (stats["group"], json.dumps(stats, ensure_ascii=False)))
+        con.commit()
+
+def get_import_progress(group_name: str = None) -> dict:
+    """Tiến độ các lượt nhập kho đang chạy/vừa xong: thống kê của 1 nhóm, hoặc {group_name: thống kê}."""
+    with db_read() as con:
+        if group_name is not None:
+            row = con.execute("SELECT stats FROM import_progress WHERE group_name=?", (group_name,)).fetchone()
+            return json.loads(row['stats']) if row else {}
+        return {r['group_name']: json.loads(r['stats']) for r in con.execute("SELECT group_name, stats FROM import_progress")}
+
+def _import_local_stock_chunk(group_name, chunk, now, skip_duplicates, stats):
+    """Ghi 1 lô vào local_stock, đếm dòng trùng (trong lô hoặc đã có trong kho)."""
+    existing = set()
+    unique_lines = list(set(chunk))
+    with db() as con:
+        # Tra dòng đã tồn tại bằng chỉ mục (group_name, content), mỗi lần tối đa 500 tham số
+        for i in range(0, len(unique_lines), 500):
+            part = unique_lines[i:i + 500]
+            rows = con.execute(
+                f"SELECT content FROM local_stock WHERE group_name=? AND content IN ({','.join(['?'] * len(part))})",
+                [group_name] + part,
+            ).fetchall()
+            existing.update(r['content'] for r in rows)
+
+        to_insert = []
+        for line in chunk:
+            if line in existing:
+                stats["duplicates"] += 1
+                if skip_duplicates:
+                    continue
+            existing.add(line)
+            to_insert.append((group_name, line, now))
+
+        con.executemany("INSERT INTO local_stock(group_name, content, added_at) VALUES(?,?,?)", to_insert)
+        con.commit()
+    stats["inserted"] += len(to_insert)
+
+def import_local_stock_lines(group_name, lines, skip_duplicates=False) -> dict:
+    """
+    Nhập kho từ một iterator dòng theo từng lô IMPORT_CHUNK_SIZE dòng.
+    Trả về thống kê: inserted (đã thêm), skipped (dòng trống), duplicates (dòng trùng).
+    """
+    stats = {"group": group_name, "processed": 0, "inserted": 0, "skipped": 0, "duplicates": 0,
+             "done": False, "started_at": get_vn_time(), "seconds": 0.0}
+    _save_import_progress(stats)
+    started = time.time()
+    now = get_vn_time() # Dùng giờ Việt Nam
+
+    chunk = []
+    for line in lines:
+        stats["processed"] += 1
+        line = line.strip()
+        if not line:
+            stats["skipped"] += 1
+            continue
+        chunk.append(line)
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            _import_local_stock_chunk(group_name, chunk, now, skip_duplicates, stats)
+            chunk = []
+            stats["seconds"] = round(time.time() - started, 3)
+            _save_import_progress(stats)
+    if chunk:
+        _import_local_stock_chunk(group_name, chunk, now, skip_duplicates, stats)
+
+    stats["seconds"] = round(time.time() - started, 3)
+    stats["done"] = True
+    _save_import_progress(stats)
+    print(f"INFO: Nhập kho '{group_name}': {stats['inserted']} thêm, {stats['skipped']} trống, "
+          f"{stats['duplicates']} trùng trong {stats['seconds']}s.")
+    return stats
+
+def iter_local_stock_rows(group_name, added_from=None, added_to=None, batch_size=None):
+    """
+    Duyệt kho theo từng lô (keyset theo id trên chỉ mục (group_name, id)).
+    Mỗi lô dùng 1 truy vấn ngắn, không giữ transaction đọc mở suốt thời gian client tải.
+    """
+    batch_size = batch_size or EXPORT_BATCH_SIZE
+    conditions = ["group_name=?", "id>?"]
+    extra = []
+    if added_from:
+        conditions.append("added_at>=?"); extra.append(added_from)
+    if added_to:
+        conditions.append("added_at<=?"); extra.append(added_to)
+    sql = f"SELECT id, content FROM local_stock WHERE {' AND '.join(conditions)} ORDER BY id LIMIT ?"
+
+    last_id = 0
+    while True:
+        with db_read() as con:
+            rows = con.execute(sql, [group_name, last_id] + extra + [batch_size]).fetchall()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1]['id']
 
 def fetch_local_stock(group_name, qty):
     """
@@ -509,28 +1811,81 @@ def fetch_local_stock(group_name, qty):
     QUAN TRỌNG: 
     1. Hàng sau khi lấy sẽ được lưu vào LOCAL HISTORY.
     2. Hàng sẽ bị XÓA VĨNH VIỄN khỏi kho (Stock) để tránh bán trùng.
+    Toàn bộ nằm trong 1 transaction BEGIN IMMEDIATE, nên an toàn giữa nhiều thread lẫn nhiều worker Gunicorn
+    mà không cần giữ db_lock (khóa riêng của tiến trình). Lưu ý: BEGIN IMMEDIATE lấy khóa ghi DUY NHẤT của cả file DB,
+    nên mọi lần lấy hàng (kể cả khác nhóm) và mọi lệnh ghi khác vẫn chạy tuần tự, chỉ là mỗi transaction rất ngắn.
     """
-    products = []
-    with db_lock:
-        with db() as con:
-            # Lấy N dòng đầu tiên
-            rows = con.execute("SELECT id, content FROM local_stock WHERE group_name=? LIMIT ?", (group_name, qty)).fetchall()
-            if not rows: return []
-            
-            ids_to_delete = [r['id'] for r in rows]
-            
-            # 1. LƯU VÀO LỊCH SỬ TRƯỚC
-            now = get_vn_time()
-            for r in rows:
-                con.execute("INSERT INTO local_history(group_name, content, fetched_at) VALUES(?,?,?)", (group_name, r['content'], now))
-            
-            # 2. XÓA KHỎI KHO (Để tránh bán trùng)
-            con.execute(f"DELETE FROM local_stock WHERE id IN ({','.join(['?']*len(ids_to_delete))})", ids_to_delete)
+    con = db()
+    if con.in_transaction:
+        con.commit()
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        rows = _claim_local_stock(con, group_name, qty)
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+
+    return [{"product": r['content']} for r in rows]
+
+def _claim_local_stock(con, group_name, qty) -> list:
+    """Nhận tối đa qty dòng của nhóm và ghi lịch sử, trong transaction đang mở của con."""
+    # 1. NHẬN HÀNG: Xóa N dòng đầu tiên của nhóm và lấy nội dung ngay trong cùng câu lệnh
+    rows = con.execute("""
+        DELETE FROM local_stock WHERE id IN (
+            SELECT id FROM local_stock WHERE group_name=? ORDER BY id LIMIT ?
+        )
+        RETURNING id, content
+    """, (group_name, qty)).fetchall()
+
+    # 2. LƯU VÀO LỊCH SỬ (1 lệnh executemany)
+    rows.sort(key=lambda r: r['id'])
+    if rows:
+        now = get_vn_time()
+        con.executemany("INSERT INTO local_history(group_name, content, fetched_at) VALUES(?,?,?)",
+                        [(group_name, r['content'], now) for r in rows])
+    return rows
+
+def claim_local_stock_batch(claims: list) -> tuple:
+    """
+    Lấy hàng cho nhiều key local [(key, group_name, qty)] trong 1 transaction BEGIN IMMEDIATE (1 lần commit).
+    Tất cả hoặc không: gặp key đầu tiên không đủ hàng thì dừng và rollback toàn bộ.
+    Trả về ({key: [items]}, {}) khi thành công, hoặc ({}, {key: số dòng còn trong nhóm}) khi thiếu hàng,
+    gồm mọi key thuộc nhóm có tổng số lượng yêu cầu vượt tồn kho (các key cùng nhóm được cộng dồn).
+    """
+    claimed = {}
+    demand = {}
+    for _, group_name, qty in claims:
+        demand[group_name] = demand.get(group_name, 0) + qty
+    con = db()
+    if con.in_transaction:
+        con.commit()
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        # Tồn kho trước khi lấy, đọc trong cùng transaction (không bị lệch bởi lệnh nhập kho chen vào sau rollback)
+        available = {}
+        for group_name in demand:
+            row = con.execute("SELECT cnt FROM local_stock_counts WHERE group_name=?", (group_name,)).fetchone()
+            available[group_name] = row['cnt'] if row else 0
+        for key, group_name, qty in claims:
+            rows = _claim_local_stock(con, group_name, qty)
+            if len(rows) < qty:
+                con.rollback()
+                break
+            claimed[key] = [{"product": r['content']} for r in rows]
+        else:
             con.commit()
-            
-            for r in rows:
-                products.append({"product": r['content']})
-    return products
+            return claimed, {}
+    except Exception:
+        con.rollback()
+        raise
+
+    shortages = {key: available[group_name] for key, group_name, _ in claims
+                 if demand[group_name] > available[group_name]}
+    if not shortages:
+        # Bảng đếm lệch với số dòng thực: vẫn báo thiếu cho key không lấy đủ
+        shortages = {key: available[group_name] for key, group_name, _ in claims if key not in claimed}
+    return {}, shortages
 
 # --- 2. XỬ LÝ API MAIL72H (VÀ CÁC API TƯƠNG TỰ) ---
 def _mail72h_collect_all_products(obj):
@@ -545,62 +1900,266 @@ def _mail72h_collect_all_products(obj):
                 all_products.extend(products_in_category)
     return all_products
 
+def _mail72h_build_stock_index(list_data) -> dict:
+    """
+    Chuyển danh mục sản phẩm thành bảng tra cứu {product_id (chuỗi đã chuẩn hóa): amount}.
+    Chỉ chuẩn hóa ID một lần khi parse, mọi key trỏ tới cùng provider dùng lại bảng này.
+    Trả về None nếu nhà cung cấp báo lỗi.
+    """
+    if not isinstance(list_data, dict) or list_data.get("status") != "success":
+        return None
+    index = {}
+    for item in _mail72h_collect_all_products(list_data) or []:
+        if not isinstance(item, dict):
+            continue
+        try:
+            item_id_str = str(int(float(str(item.get("id", 0)))))
+        except:
+            continue
+        # Giữ sản phẩm xuất hiện đầu tiên (giống logic duyệt tuần tự cũ)
+        if item_id_str in index:
+            continue
+        try:
+            index[item_id_str] = int(item.get("amount", 0))
+        except:
+            index[item_id_str] = 0
+    return index
+
 def mail72h_format_buy(base_url: str, api_key: str, product_id: int, amount: int) -> dict:
     data = {"action": "buyProduct", "id": product_id, "amount": amount, "api_key": api_key}
     url = f"{base_url.rstrip('/')}/api/buy_product"
-    r = requests.post(url, data=data, timeout=DEFAULT_TIMEOUT, proxies=CURRENT_PROXY_SET) 
+    r = routed_request("POST", url, data=data)
     r.raise_for_status()
     return r.json()
 
-def mail72h_format_product_list(base_url: str, api_key: str) -> dict:
+def mail72h_format_product_list(base_url: str, api_key: str, proxy_string: str = None) -> dict:
     params = {"api_key": api_key}
     url = f"{base_url.rstrip('/')}/api/products.php"
-    r = requests.get(url, params=params, timeout=DEFAULT_TIMEOUT, proxies=CURRENT_PROXY_SET)
+    r = routed_request("GET", url, params=params, proxy_string=proxy_string)
     r.raise_for_status()
     return r.json()
 
-def stock_mail72h_format(row):
-    for retry_count in range(2): 
+# --- HEDGING CHO ĐỌC DANH MỤC ---
+# base_url -> deque độ trễ (giây) của các lần gọi products.php thành công gần đây
+_catalog_latency = {}
+_hedge_lock = threading.Lock()
+_hedge_executor = ThreadPoolExecutor(max_workers=CATALOG_HEDGE_WORKERS, thread_name_prefix="hedge")
+catalog_hedge_stats = {"requests": 0, "hedged": 0, "hedge_wins": 0, "errors": 0}
+
+def _hedge_delay(base_url: str) -> float:
+    """Thời gian chờ trước khi gửi request thứ 2 = phân vị CATALOG_HEDGE_PERCENTILE của độ trễ gần đây."""
+    with _hedge_lock:
+        samples = sorted(_catalog_latency.get(base_url, ()))
+    if len(samples) < CATALOG_HEDGE_MIN_SAMPLES:
+        return DEFAULT_TIMEOUT / 2
+    idx = min(len(samples) - 1, int(len(samples) * CATALOG_HEDGE_PERCENTILE / 100))
+    return samples[idx]
+
+def _timed_product_list(base_url: str, api_key: str, proxy_string: str) -> dict:
+    started = time.time()
+    data = mail72h_format_product_list(base_url, api_key, proxy_string)
+    with _hedge_lock:
+        window = _catalog_latency.get(base_url)
+        if window is None:
+            window = _catalog_latency[base_url] = deque(maxlen=200)
+        window.append(time.time() - started)
+    return data
+
+def hedged_product_list(base_url: str, api_key: str) -> dict:
+    """
+    Gọi products.php có hedging (khi CATALOG_HEDGE bật): request đầu chậm hơn phân vị độ trễ gần đây
+    thì gửi request thứ 2 qua proxy sống khác, trả về kết quả thành công đến trước.
+    """
+    if not CATALOG_HEDGE:
+        return mail72h_format_product_list(base_url, api_key)
+
+    with _hedge_lock:
+        catalog_hedge_stats["requests"] += 1
+    first_proxy = pick_proxy()
+    first = _hedge_executor.submit(_timed_product_list, base_url, api_key, first_proxy)
+    try:
+        return first.result(timeout=_hedge_delay(base_url))
+    except FuturesTimeoutError:
+        pass
+
+    second_proxy = pick_proxy(exclude=(first_proxy,))
+    if not second_proxy or second_proxy == first_proxy:
+        # Không có proxy nào khác để hedge
+        return first.result()
+    with _hedge_lock:
+        catalog_hedge_stats["hedged"] += 1
+    second = _hedge_executor.submit(_timed_product_list, base_url, api_key, second_proxy)
+
+    last_error = None
+    for fut in as_completed([first, second]):
         try:
-            base_url = row['base_url'] 
-            pid_to_find_str = str(row["product_id"])
-            list_data = mail72h_format_product_list(base_url, row["api_key"])
-            
-            if list_data.get("status") != "success":
-                return jsonify({"sum": 0}), 200
+            data = fut.result()
+        except Exception as e:
+            last_error = e
+            continue
+        if fut is second:
+            with _hedge_lock:
+                catalog_hedge_stats["hedge_wins"] += 1
+        return data
+    with _hedge_lock:
+        catalog_hedge_stats["errors"] += 1
+    raise last_error
+
+def get_catalog_hedge_stats() -> dict:
+    with _hedge_lock:
+        stats = dict(catalog_hedge_stats)
+    stats["enabled"] = CATALOG_HEDGE
+    stats["hedge_rate"] = round(stats["hedged"] / stats["requests"], 4) if stats["requests"] else 0.0
+    stats["win_rate"] = round(stats["hedge_wins"] / stats["hedged"], 4) if stats["hedged"] else 0.0
+    stats["delay"] = {base_url: round(_hedge_delay(base_url), 4) for base_url in list(_catalog_latency)}
+    return stats
+
+# --- 3. CACHE DANH MỤC SẢN PHẨM (CATALOG CACHE + SINGLE-FLIGHT) ---
+# Key: (base_url, api_key) -> (thời điểm hết hạn, bảng tra cứu {product_id: amount})
+_catalog_cache = OrderedDict()
+# Các request đang bay: Key -> {"event", "data", "error"}
+_catalog_inflight = {}
+_catalog_lock = threading.Lock()
+catalog_cache_stats = {"hits": 0, "misses": 0, "shared": 0, "errors": 0}
+
+def get_catalog_index(base_url: str, api_key: str) -> dict:
+    """
+    Lấy bảng tra cứu tồn kho {product_id: amount} của provider qua cache.
+    Trả về None nếu provider báo lỗi (không cache kết quả lỗi).
+    - Còn hạn TTL: trả về ngay (hit).
+    - Hết hạn: chỉ 1 luồng gọi API (miss), các luồng khác cùng provider chờ và dùng chung kết quả (shared).
+    """
+    cache_key = (base_url, api_key)
+    with _catalog_lock:
+        entry = _catalog_cache.get(cache_key)
+        if entry and entry[0] > time.time():
+            _catalog_cache.move_to_end(cache_key)
+            catalog_cache_stats["hits"] += 1
+            return entry[1]
+
+        flight = _catalog_inflight.get(cache_key)
+        is_leader = flight is None
+        if is_leader:
+            flight = {"event": threading.Event(), "data": None, "error": None}
+            _catalog_inflight[cache_key] = flight
+            catalog_cache_stats["misses"] += 1
+        else:
+            catalog_cache_stats["shared"] += 1
 
-            products = _mail72h_collect_all_products(list_data)
-            if not products: return jsonify({"sum": 0}), 200
+    # Luồng đi sau: chờ luồng dẫn đầu gọi API xong
+    if not is_leader:
+        if not flight["event"].wait(DEFAULT_TIMEOUT * 2):
+            raise requests.exceptions.Timeout(f"Catalog fetch timeout: {base_url}")
+        if flight["error"] is not None:
+            raise flight["error"]
+        return flight["data"]
 
-            stock_val = 0
-            for item in products:
-                try:
-                    item_id_str = str(int(float(str(item.get("id", 0)))))
-                except:
-                    continue
-                    
-                if item_id_str == pid_to_find_str:
-                    stock_val = int(item.get("amount", 0))
-                    break
-            
-            return jsonify({"sum": stock_val})
-        
+    # Luồng dẫn đầu: gọi API thật
+    try:
+        index = _mail72h_build_stock_index(hedged_product_list(base_url, api_key))
+        flight["data"] = index
+        # Chỉ cache khi nhà cung cấp trả về thành công
+        if CATALOG_CACHE_TTL > 0 and index is not None:
+            with _catalog_lock:
+                _catalog_cache[cache_key] = (time.time() + CATALOG_CACHE_TTL, index)
+                _catalog_cache.move_to_end(cache_key)
+                while len(_catalog_cache) > CATALOG_CACHE_MAX:
+                    _catalog_cache.popitem(last=False)
+        return index
+    except Exception as e:
+        flight["error"] = e
+        with _catalog_lock:
+            catalog_cache_stats["errors"] += 1
+        raise
+    finally:
+        with _catalog_lock:
+            _catalog_inflight.pop(cache_key, None)
+        flight["event"].set()
+
+def get_catalog_cache_stats() -> dict:
+    """Thống kê hit/miss của cache danh mục (dùng để tinh chỉnh TTL)."""
+    with _catalog_lock:
+        stats = dict(catalog_cache_stats)
+        stats["size"] = len(_catalog_cache)
+    lookups = stats["hits"] + stats["misses"] + stats["shared"]
+    stats["hit_ratio"] = round((stats["hits"] + stats["shared"]) / lookups, 4) if lookups else 0.0
+    stats["ttl"] = CATALOG_CACHE_TTL
+    stats["max_size"] = CATALOG_CACHE_MAX
+    stats["hedge"] = get_catalog_hedge_stats()
+    return stats
+
+def lookup_catalog_index(base_url: str, api_key: str):
+    """Bảng tra cứu tồn kho của provider (qua cache), thử lại 1 lần khi lỗi proxy. Lỗi khác trả về None."""
+    for retry_count in range(2): 
+        try:
+            return get_catalog_index(base_url, api_key)
         except requests.exceptions.ProxyError:
-            switch_to_next_live_proxy()
+            # Chế độ định tuyến: proxy lỗi đã bị loại, lần thử lại sẽ đi qua proxy khác
+            if not PROXY_ROUTING:
+                switch_to_next_live_proxy()
             continue
         except Exception:
-            return jsonify({"sum": 0}), 200
-            
-    return jsonify({"sum": 0}), 200
+            return None
+    return None
 
-def fetch_mail72h_format(row, qty):
+def stock_mail72h_format(row):
+    stock_index = lookup_catalog_index(row['base_url'], row["api_key"])
+    if stock_index is None:
+        return jsonify({"sum": 0}), 200
+    return jsonify({"sum": stock_index.get(str(row["product_id"]), 0)})
+
+def batch_stock_sums(keys: list) -> dict:
+    """
+    Tồn kho cho nhiều key cùng lúc, cùng ngữ nghĩa với /stock (key lạ hoặc lỗi = 0).
+    - Key local: 1 truy vấn IN trên bảng đếm local_stock_counts.
+    - Key API: gom theo (provider_type, base_url, api_key), mỗi nhóm chỉ lấy danh mục 1 lần (các nhóm chạy song song).
+    """
+    result = {}
+    local_keys = {}
+    upstream = {}
+    for key in keys:
+        row = find_map_by_key(key)
+        if not row:
+            result[key] = 0
+        elif row['provider_type'] == 'local':
+            local_keys[key] = row['group_name']
+        else:
+            upstream.setdefault((row['provider_type'], row['base_url'], row['api_key']), []).append((key, row))
+
+    if local_keys:
+        names = sorted({g for g in local_keys.values() if g is not None})
+        counts = {}
+        if names:
+            with db_read() as con:
+                counts = {r['group_name']: r['cnt'] for r in con.execute(
+                    f"SELECT group_name, cnt FROM local_stock_counts WHERE group_name IN ({','.join('?' * len(names))})", names)}
+        for key, group_name in local_keys.items():
+            result[key] = counts.get(group_name, 0)
+
+    if upstream:
+        def answer_group(group):
+            (_, base_url, api_key), members = group
+            index = lookup_catalog_index(base_url, api_key) or {}
+            return {key: index.get(str(row["product_id"]), 0) for key, row in members}
+
+        if len(upstream) == 1:
+            result.update(answer_group(next(iter(upstream.items()))))
+        else:
+            with ThreadPoolExecutor(max_workers=max(1, min(BATCH_UPSTREAM_CONCURRENCY, len(upstream)))) as pool:
+                for sums in pool.map(answer_group, upstream.items()):
+                    result.update(sums)
+
+    return {key: result[key] for key in keys}
+
+def buy_mail72h_items(row, qty) -> list:
+    """Mua qty sản phẩm từ nhà cung cấp, trả về danh sách [{"product": ...}] như /fetch (lỗi = [])."""
     for retry_count in range(2): 
         try:
             base_url = row['base_url']
             res = mail72h_format_buy(base_url, row["api_key"], int(row["product_id"]), qty)
             
             if res.get("status") != "success":
-                return jsonify([]), 200
+                return []
 
             data = res.get("data")
             out = []
@@ -612,15 +2171,52 @@ def fetch_mail72h_format(row, qty):
                 val = json.dumps(data, ensure_ascii=False) if isinstance(data, dict) else str(data)
                 out = [{"product": val} for _ in range(qty)]
             
-            return jsonify(out)
+            return out
             
         except requests.exceptions.ProxyError:
-            switch_to_next_live_proxy()
+            # Chế độ định tuyến: proxy lỗi đã bị loại, lần thử lại sẽ đi qua proxy khác
+            if not PROXY_ROUTING:
+                switch_to_next_live_proxy()
             continue
         except Exception:
-            return jsonify([]), 200
+            return []
             
-    return jsonify([]), 200
+    return []
+
+def fetch_mail72h_format(row, qty):
+    return jsonify(buy_mail72h_items(row, qty)), 200
+
+def batch_fetch(items: dict) -> tuple:
+    """
+    Lấy hàng cho nhiều key {key: quantity}, mỗi key trả về danh sách cùng định dạng /fetch.
+    - Key local: lấy trong 1 transaction, tất cả hoặc không (claim_local_stock_batch).
+    - Key API: các lệnh mua độc lập chạy song song (tối đa BATCH_UPSTREAM_CONCURRENCY), chỉ gửi sau khi phần local thành công.
+    Trả về (kết quả, thiếu hàng); thiếu hàng khác rỗng nghĩa là không key nào được lấy.
+    """
+    result = {key: [] for key in items}
+    local_claims, upstream = [], []
+    for key, qty in items.items():
+        row = find_map_by_key(key)
+        if not row or qty <= 0:
+            continue
+        if row['provider_type'] == 'local':
+            local_claims.append((key, row['group_name'], qty))
+        else:
+            upstream.append((key, row, qty))
+
+    if local_claims:
+        claimed, shortages = claim_local_stock_batch(local_claims)
+        missing = [key for key, _, _ in local_claims if key not in claimed]
+        if shortages or missing:
+            return result, shortages or {key: 0 for key in missing}
+        result.update(claimed)
+
+    if upstream:
+        with ThreadPoolExecutor(max_workers=max(1, min(BATCH_UPSTREAM_CONCURRENCY, len(upstream)))) as pool:
+            futures = {pool.submit(buy_mail72h_items, row, qty): key for key, row, qty in upstream}
+            for fut, key in futures.items():
+                result[key] = fut.result()
+    return result, {}
 
 
 # ==============================================================================
@@ -766,6 +2362,8 @@ ADMIN_TPL = """
     button:hover, .btn:hover { filter: brightness(1.1); transform: translateY(-1px); }
     .btn.red { background: var(--red); } .btn.green { background: var(--green); } .btn.blue { background: var(--blue); } .btn.gray { background: var(--gray); }
     .btn.small { padding: 6px 12px; font-size: 12px; }
+    .lazy-more { display: none; margin-top: 8px; }
+    .lazy-note { text-align: center; color: var(--text-light); padding: 10px; }
 
     /* --- TABLES (DÙNG CHO LOCAL STOCK & PROXY) --- */
     table { width: 100%; border-collapse: collapse; margin-top: 15px; font-size: 13px; }
@@ -856,54 +2454,8 @@ ADMIN_TPL = """
 
   <div class="card">
     <h3>2. Danh Sách Keymaps (Theo Website)</h3>
-    {% if not grouped_data %}<p style="text-align: center; color: var(--text-light); padding: 20px;">Chưa có key nào được thêm.</p>{% endif %}
-
-    {% for folder, providers in grouped_data.items() %}
-      <details class="folder">
-        <summary>📁 Website: {{ folder }}</summary>
-        <div class="content">
-          
-          {% for provider, keys in providers.items() %}
-            <details class="provider">
-              <summary>📦 Provider: {{ provider }} ({{ keys|length }} keys)</summary>
-              <div class="content">
-                
-                <table class="provider-table">
-                  <thead>
-                    <tr>
-                      <th style="width: 25%;">SKU</th>
-                      <th style="width: 25%;">INPUT KEY</th>
-                      <th style="width: 20%;">BASE URL</th>
-                      <th style="width: 5%;">ID</th>
-                      <th style="width: 5%;">ACTIVE</th>
-                      <th style="width: 20%;">HÀNH ĐỘNG</th>
-                    </tr>
-                  </thead>
-                  <tbody>
-                  {% for k in keys %}
-                    <tr>
-                      <td><span class="truncate-sku-cell">{{ k.sku }}</span></td>
-                      <td><span class="badge-key">{{ k.input_key }}</span></td>
-                      <td><span class="badge-url">{{ k.base_url }}</span></td>
-                      <td>{{ k.product_id }}</td> 
-                      <td>{% if k.is_active %}<span style="color: var(--green);">✅</span>{% else %}<span style="color: var(--red);">❌</span>{% endif %}</td>
-                      <td> 
-                        <div style="display: flex; gap: 5px;">
-                            <form method="post" action="{{ url_for('admin_toggle_key', kmid=k.id) }}" style="margin:0;"><button class="btn blue small" type="submit">{{ 'Tắt' if k.is_active else 'Bật' }}</button></form>
-                            <form method="post" action="{{ url_for('admin_delete_key', kmid=k.id) }}" onsubmit="return confirm('Xác nhận xóa key này?');" style="margin:0;"><button class="btn red small" type="submit">Xoá</button></form>
-                        </div>
-                      </td>
-                    </tr>
-                  {% endfor %}
-                  </tbody>
-                </table>
-              </div>
-            </details>
-          {% endfor %}
-          
-        </div>
-      </details>
-    {% endfor %}
+    <div id="keymap-tree"><p class="lazy-note">Đang tải...</p></div>
+    <button type="button" class="btn gray small lazy-more" id="keymap-groups-more">Tải thêm Website</button>
   </div>
 
   <div class="card">
@@ -913,12 +2465,13 @@ ADMIN_TPL = """
         <h4>Tải Backup (JSON)</h4>
         <p style="color: var(--text-light); margin-bottom: 15px;">Render sẽ xóa sạch dữ liệu khi Restart. Hãy tải file này thường xuyên.</p>
         <a href="{{ url_for('admin_backup_download') }}" class="btn green">⬇️ Tải Xuống Backup</a>
+        <form method="post" action="{{ url_for('admin_backup_restore_chain') }}" style="display: inline;" onsubmit="return confirm('Khôi phục từ bản backup đầy đủ + các delta trên server? Dữ liệu hiện tại sẽ bị ghi đè.');"><button type="submit" class="btn blue">♻️ Restore Từ Backup Tự Động</button></form>
       </div>
       <div class="col-6" style="border-left: 1px solid var(--border); padding-left: 20px;">
         <h4>Restore Thủ Công</h4>
         <p style="color: var(--text-light); margin-bottom: 15px;">Upload file JSON để khôi phục dữ liệu ngay lập tức.</p>
         <form method="post" action="{{ url_for('admin_backup_upload') }}" enctype="multipart/form-data" onsubmit="return confirm('CẢNH BÁO: Ghi đè dữ liệu?');">
-          <input type="file" name="backup_file" accept=".json" required style="margin-bottom: 10px;"><button type="submit" class="btn red">⬆️ Upload & Restore</button>
+          <input type="file" name="backup_file" accept=".json,.gz" required style="margin-bottom: 10px;"><button type="submit" class="btn red">⬆️ Upload & Restore</button>
         </form>
       </div>
     </div>
@@ -929,19 +2482,21 @@ ADMIN_TPL = """
         <h3 style="color: var(--green);">📦 4. Kho Hàng Thủ Công (Local Stock)</h3>
         
         <form method="post" action="{{ url_for('admin_local_stock_add') }}" enctype="multipart/form-data">
-            <div style="margin-bottom: 15px;"><label>Group Name (Phải trùng với Keymap đã tạo)</label><input class="mono" name="group_name" list="group_hints" required placeholder="VD: Netflix"><datalist id="group_hints">{% for g in local_groups %}<option value="{{ g }}">{% endfor %}</datalist></div>
+            <div style="margin-bottom: 15px;"><label>Group Name (Phải trùng với Keymap đã tạo)</label><input class="mono" name="group_name" list="group_hints" required placeholder="VD: Netflix"><datalist id="group_hints"></datalist></div>
             
             <div class="row">
                 <div class="col-6"><div style="border: 1px dashed var(--border); padding: 10px; border-radius: 6px;"><label style="color: var(--primary);">Cách 1: Upload File .txt</label><input type="file" name="stock_file" accept=".txt" class="mono" style="margin-top: 5px;"></div></div>
                 <div class="col-6"><label>Cách 2: Dán Dữ Liệu (Mỗi dòng 1 acc)</label><textarea class="mono" name="content" rows="3" placeholder="user|pass..."></textarea></div>
             </div>
             
+            <label style="margin-top: 10px; display: flex; align-items: center; gap: 8px; text-transform: none;"><input type="checkbox" name="skip_duplicates" value="1" style="width: auto;"> Bỏ qua dòng trùng (đã có trong kho hoặc lặp trong file)</label>
             <button type="submit" class="btn green" style="width: 100%; margin-top: 15px;">⬆️ Up Hàng Vào Kho</button>
         </form>
         
-        <h4 style="margin-top: 25px; border-bottom: 1px solid var(--border); padding-bottom: 5px;">Thống Kê Tồn Kho</h4>
-        <div style="max-height: 250px; overflow-y: auto;">
-            {% for g, c in local_stats.items() %}<div style="display: flex; justify-content: space-between; padding: 8px 0; border-bottom: 1px dashed var(--border);"><span><b style="color: var(--primary);">{{ g }}</b>: <span style="background: var(--input-bg); padding: 2px 6px; border-radius: 4px;">{{ c }} items</span></span><div><a href="{{ url_for('admin_local_stock_view', group=g) }}" class="btn blue small">Xem/Lấy</a><form action="{{ url_for('admin_local_stock_clear') }}" method="post" style="display: inline;" onsubmit="return confirm('XÓA SẠCH kho {{g}}?');"><input type="hidden" name="group_name" value="{{ g }}"><button class="btn red small">Xóa</button></form></div></div>{% else %}<p style="text-align: center; color: var(--text-light); padding: 10px;">Kho đang trống.</p>{% endfor %}
+        <h4 style="margin-top: 25px; border-bottom: 1px solid var(--border); padding-bottom: 5px; display: flex; justify-content: space-between; align-items: center;">Thống Kê Tồn Kho<form action="{{ url_for('admin_local_stock_recount') }}" method="post" style="margin: 0;"><button class="btn gray small" type="submit">🔄 Đếm Lại</button></form></h4>
+        <div style="max-height: 250px; overflow-y: auto;" id="stock-stats">
+            <p class="lazy-note">Đang tải...</p>
+            <button type="button" class="btn gray small lazy-more" id="stock-stats-more">Tải thêm nhóm</button>
         </div>
     </div>
 
@@ -959,24 +2514,9 @@ ADMIN_TPL = """
         <div style="margin-top: 20px; max-height: 200px; overflow-y: auto; border: 1px solid var(--border); border-radius: 6px;">
             <table style="margin: 0;">
                 <thead><tr><th>Proxy</th><th>Status</th><th>Ping</th><th>Xóa</th></tr></thead>
-                <tbody>
-                {% for p in proxies %}
-                    <tr>
-                        <td class="mono" style="font-size: 11px;">{{ p.proxy_string }}</td>
-                        <td style="font-weight: bold; color: {{ 'var(--green)' if p.is_live else 'var(--red)' }};">
-                            {{ 'LIVE' if p.is_live else 'DIE' }}
-                        </td>
-                        <td>{{ "%.2f"|format(p.latency) }}s</td>
-                        <td>
-                            <form action="{{ url_for('admin_delete_proxy') }}" method="post">
-                                <input type="hidden" name="id" value="{{ p.id }}">
-                                <button class="btn red small" style="padding: 2px 6px;">x</button>
-                            </form>
-                        </td>
-                    </tr>
-                {% endfor %}
-                </tbody>
+                <tbody id="proxy-rows"></tbody>
             </table>
+            <button type="button" class="btn gray small lazy-more" id="proxy-more">Tải thêm proxy</button>
         </div>
         
         <hr style="border-color: var(--border); margin: 25px 0;">
@@ -1008,6 +2548,163 @@ ADMIN_TPL = """
 
 </div> 
 
+<script>
+// --- TẢI DỮ LIỆU DASHBOARD THEO YÊU CẦU (JSON PHÂN TRANG) ---
+const LAZY_URLS = {
+    groups: "{{ url_for('admin_api_keymap_groups') }}",
+    keymaps: "{{ url_for('admin_api_keymaps') }}",
+    proxies: "{{ url_for('admin_api_proxies') }}",
+    stock: "{{ url_for('admin_api_local_stock_stats') }}",
+    toggleKey: "{{ url_for('admin_toggle_key', kmid=0)[:-1] }}",
+    deleteKey: "{{ url_for('admin_delete_key', kmid=0)[:-1] }}",
+    deleteProxy: "{{ url_for('admin_delete_proxy') }}",
+    stockView: "{{ url_for('admin_local_stock_view') }}",
+    stockClear: "{{ url_for('admin_local_stock_clear') }}",
+};
+
+// Tạo phần tử DOM; chuỗi con được thêm dưới dạng text (không chèn HTML) nên an toàn với dữ liệu người dùng
+function el(tag, attrs, ...children) {
+    const e = document.createElement(tag);
+    for (const [k, v] of Object.entries(attrs || {})) {
+        if (k === 'style') e.style.cssText = v; else e.setAttribute(k, v);
+    }
+    for (const c of children) if (c !== null && c !== undefined) e.append(c);
+    return e;
+}
+
+function postButton(action, fields, label, cls, confirmMsg) {
+    const f = el('form', {method: 'post', action: action, style: 'margin: 0; display: inline;'});
+    for (const [k, v] of Object.entries(fields)) f.append(el('input', {type: 'hidden', name: k, value: v}));
+    if (confirmMsg) f.addEventListener('submit', (ev) => { if (!confirm(confirmMsg)) ev.preventDefault(); });
+    f.append(el('button', {class: cls, type: 'submit'}, label));
+    return f;
+}
+
+async function getJSON(url, params) {
+    const qs = new URLSearchParams();
+    for (const [k, v] of Object.entries(params || {})) if (v !== null && v !== undefined) qs.set(k, v);
+    const r = await fetch(url + '?' + qs.toString(), {credentials: 'same-origin'});
+    if (!r.ok) throw new Error('HTTP ' + r.status);
+    return r.json();
+}
+
+// Chạy fn khi phần tử lần đầu xuất hiện trên màn hình
+function whenVisible(node, fn) {
+    if (!('IntersectionObserver' in window)) return fn();
+    const io = new IntersectionObserver((entries) => {
+        if (entries.some(e => e.isIntersecting)) { io.disconnect(); fn(); }
+    });
+    io.observe(node);
+}
+
+function lazyError(box, err) {
+    box.append(el('p', {class: 'lazy-note', style: 'color: var(--red);'}, 'Lỗi tải dữ liệu: ' + err.message));
+}
+
+function renderKeyRow(k) {
+    return el('tr', {},
+        el('td', {}, el('span', {class: 'truncate-sku-cell'}, k.sku)),
+        el('td', {}, el('span', {class: 'badge-key'}, k.input_key)),
+        el('td', {}, el('span', {class: 'badge-url'}, k.base_url || '')),
+        el('td', {}, String(k.product_id)),
+        el('td', {}, k.is_active ? el('span', {style: 'color: var(--green);'}, '✅') : el('span', {style: 'color: var(--red);'}, '❌')),
+        el('td', {}, el('div', {style: 'display: flex; gap: 5px;'},
+            postButton(LAZY_URLS.toggleKey + k.id, {}, k.is_active ? 'Tắt' : 'Bật', 'btn blue small'),
+            postButton(LAZY_URLS.deleteKey + k.id, {}, 'Xoá', 'btn red small', 'Xác nhận xóa key này?'))));
+}
+
+function renderProvider(group, provider, count) {
+    const tbody = el('tbody');
+    const more = el('button', {type: 'button', class: 'btn gray small lazy-more'}, 'Tải thêm key');
+    const head = el('tr', {}, ...[['SKU', 25], ['INPUT KEY', 25], ['BASE URL', 20], ['ID', 5], ['ACTIVE', 5], ['HÀNH ĐỘNG', 20]]
+        .map(([t, w]) => el('th', {style: `width: ${w}%;`}, t)));
+    const content = el('div', {class: 'content'}, el('table', {class: 'provider-table'}, el('thead', {}, head), tbody), more);
+    const d = el('details', {class: 'provider'}, el('summary', {}, `📦 Provider: ${provider} (${count} keys)`), content);
+    let cursor = {};
+    async function loadPage() {
+        try {
+            const data = await getJSON(LAZY_URLS.keymaps, {group: group, provider: provider, ...cursor});
+            for (const k of data.items) tbody.append(renderKeyRow(k));
+            cursor = data.next ? {after_sku: data.next.sku, after_id: data.next.id} : null;
+            more.style.display = cursor ? 'inline-block' : 'none';
+        } catch (e) { lazyError(content, e); }
+    }
+    more.addEventListener('click', loadPage);
+    d.addEventListener('toggle', () => { if (d.open && !d.dataset.loaded) { d.dataset.loaded = '1'; loadPage(); } });
+    return d;
+}
+
+function renderFolder(g) {
+    const content = el('div', {class: 'content'});
+    const d = el('details', {class: 'folder'}, el('summary', {}, `📁 Website: ${g.group || 'DEFAULT'} (${g.total} keys)`), content);
+    d.addEventListener('toggle', () => {
+        if (!d.open || d.dataset.loaded) return;
+        d.dataset.loaded = '1';
+        for (const [provider, count] of Object.entries(g.providers)) content.append(renderProvider(g.group, provider, count));
+    });
+    return d;
+}
+
+let groupsOffset = 0;
+async function loadKeymapGroups() {
+    const box = document.getElementById('keymap-tree'), more = document.getElementById('keymap-groups-more');
+    try {
+        const data = await getJSON(LAZY_URLS.groups, {offset: groupsOffset});
+        if (groupsOffset === 0) box.textContent = '';
+        if (groupsOffset === 0 && !data.items.length) box.append(el('p', {class: 'lazy-note'}, 'Chưa có key nào được thêm.'));
+        for (const g of data.items) box.append(renderFolder(g));
+        groupsOffset = data.next_offset;
+        more.style.display = groupsOffset === null ? 'none' : 'inline-block';
+    } catch (e) { lazyError(box, e); }
+}
+
+let stockAfter = null;
+async function loadStockStats() {
+    const box = document.getElementById('stock-stats'), more = document.getElementById('stock-stats-more');
+    const hints = document.getElementById('group_hints');
+    try {
+        const data = await getJSON(LAZY_URLS.stock, {after: stockAfter});
+        if (stockAfter === null) box.querySelectorAll('.lazy-note').forEach(n => n.remove());
+        if (stockAfter === null && !data.items.length) box.prepend(el('p', {class: 'lazy-note'}, 'Kho đang trống.'));
+        for (const s of data.items) {
+            hints.append(el('option', {value: s.group}));
+            box.insertBefore(el('div', {style: 'display: flex; justify-content: space-between; padding: 8px 0; border-bottom: 1px dashed var(--border);'},
+                el('span', {}, el('b', {style: 'color: var(--primary);'}, s.group), ': ',
+                    el('span', {style: 'background: var(--input-bg); padding: 2px 6px; border-radius: 4px;'}, `${s.count} items`)),
+                el('div', {},
+                    el('a', {href: LAZY_URLS.stockView + '?group=' + encodeURIComponent(s.group), class: 'btn blue small'}, 'Xem/Lấy'),
+                    postButton(LAZY_URLS.stockClear, {group_name: s.group}, 'Xóa', 'btn red small', `XÓA SẠCH kho ${s.group}?`))), more);
+        }
+        stockAfter = data.next;
+        more.style.display = stockAfter === null ? 'none' : 'inline-block';
+    } catch (e) { lazyError(box, e); }
+}
+
+let proxyOffset = 0;
+async function loadProxies() {
+    const tbody = document.getElementById('proxy-rows'), more = document.getElementById('proxy-more');
+    try {
+        const data = await getJSON(LAZY_URLS.proxies, {offset: proxyOffset});
+        for (const p of data.items) {
+            tbody.append(el('tr', {},
+                el('td', {class: 'mono', style: 'font-size: 11px;'}, p.proxy_string),
+                el('td', {style: `font-weight: bold; color: ${p.is_live ? 'var(--green)' : 'var(--red)'};`}, p.is_live ? 'LIVE' : 'DIE'),
+                el('td', {}, `${Number(p.latency).toFixed(2)}s`),
+                el('td', {}, postButton(LAZY_URLS.deleteProxy, {id: p.id}, 'x', 'btn red small'))));
+        }
+        proxyOffset = data.next_offset;
+        more.style.display = proxyOffset === null ? 'none' : 'inline-block';
+    } catch (e) { lazyError(tbody.parentNode.parentNode, e); }
+}
+
+document.getElementById('keymap-groups-more').addEventListener('click', loadKeymapGroups);
+document.getElementById('stock-stats-more').addEventListener('click', loadStockStats);
+document.getElementById('proxy-more').addEventListener('click', loadProxies);
+whenVisible(document.getElementById('keymap-tree'), loadKeymapGroups);
+whenVisible(document.getElementById('stock-stats'), loadStockStats);
+whenVisible(document.getElementById('proxy-rows').parentNode, loadProxies);
+</script>
+
 <script>
 function checkProviderType(input) {
     const val = input ? input.value : document.getElementById('pt_input').value;
@@ -1320,9 +3017,10 @@ STOCK_VIEW_TPL = """
 <body>
 
     <h2>
-        <span>📦 Group: {{ group }} ({{ items|length }} items)</span>
+        <span>📦 Group: {{ group }} ({{ total }} items trong nhóm{% if matched is not none %}, {{ matched }} dòng khớp "{{ query }}"{% endif %})</span>
         <div>
              <a href="{{ url_for('admin_local_stock_download', group=group) }}" style="margin-right: 15px; font-size: 14px; background:#20c997; color:#000; padding:4px 8px; border-radius:4px; text-decoration:none;">📥 Tải File TXT</a>
+             <a href="{{ url_for('admin_local_stock_download', group=group, gzip=1) }}" style="margin-right: 15px; font-size: 14px; background:#20c997; color:#000; padding:4px 8px; border-radius:4px; text-decoration:none;">🗜️ Tải .GZ</a>
              <a href="{{ url_for('admin_local_history_view') }}?group={{ group }}" style="margin-right: 15px; font-size: 14px;">📜 Xem Lịch Sử</a>
              <form action="{{ url_for('admin_local_stock_dedup') }}" method="post" style="display:inline;" onsubmit="return confirm('Bạn có chắc muốn xóa các dòng trùng lặp?');">
                 <input type="hidden" name="group_name" value="{{ group }}">
@@ -1361,7 +3059,7 @@ STOCK_VIEW_TPL = """
         <tbody>
         {% for i in items %}
             <tr>
-                <td>{{ loop.index }}</td>
+                <td>{{ pager.start + loop.index }}</td>
                 <td style="word-break: break-all; color: #20c997;">{{ i.content }}</td>
                 <td>{{ i.added_at }}</td>
                 <td>
@@ -1382,6 +3080,13 @@ STOCK_VIEW_TPL = """
         </tbody>
     </table>
 
+    <div class="tools-bar" style="margin-top: 15px; justify-content: center;">
+        <a href="{{ url_for('admin_local_stock_view', group=group, q=query) }}">⏮ Trang đầu</a>
+        {% if pager.prev_before %}<a href="{{ url_for('admin_local_stock_view', group=group, q=query, before=pager.prev_before, start=pager.prev_start) }}">◀ Trang trước</a>{% endif %}
+        <span style="color: #adb5bd;">Dòng {{ pager.start + 1 if items else 0 }} - {{ pager.next_start }}</span>
+        {% if pager.next_after %}<a href="{{ url_for('admin_local_stock_view', group=group, q=query, after=pager.next_after, start=pager.next_start) }}">Trang sau ▶</a>{% endif %}
+    </div>
+
 </body>
 </html>
 """
@@ -1497,6 +3202,21 @@ FETCH_RESULT_TPL = """
 """
 
 
+# ------------------------------------------------------------------------------
+# 7.6 NẠP TEMPLATE VÀO JINJA
+# Biên dịch 1 lần lúc khởi động; các request sau dùng bản đã biên dịch trong cache của Jinja.
+# ------------------------------------------------------------------------------
+TEMPLATES = {
+    "login.html": LOGIN_TPL,
+    "admin.html": ADMIN_TPL,
+    "stock_view.html": STOCK_VIEW_TPL,
+    "history_view.html": HISTORY_VIEW_TPL,
+    "fetch_result.html": FETCH_RESULT_TPL,
+}
+app.jinja_loader = DictLoader(TEMPLATES)
+for _name in TEMPLATES:
+    app.jinja_env.get_template(_name)
+
 # ==============================================================================
 # ==============================================================================
 #
@@ -1505,11 +3225,47 @@ FETCH_RESULT_TPL = """
 # ==============================================================================
 # ==============================================================================
 
+# --- CACHE KEYMAP TRONG BỘ NHỚ ---
+# Toàn bộ keymap đang hoạt động được nạp vào dict, nên key lạ (scraper dò key ngẫu nhiên)
+# cũng được trả lời từ bộ nhớ mà không chạm DB (negative caching).
+_keymap_cache = {"generation": None, "checked_at": 0.0, "by_key": {}}
+_keymap_cache_lock = threading.Lock()
+
+def _read_keymap_generation(con) -> str:
+    row = con.execute("SELECT value FROM config WHERE key='keymap_generation'").fetchone()
+    return row['value'] if row else ""
+
+def load_keymap_cache():
+    """Nạp lại toàn bộ keymap đang hoạt động vào bộ nhớ."""
+    with _keymap_cache_lock:
+        with db_read() as con:
+            generation = _read_keymap_generation(con)
+            rows = con.execute("SELECT * FROM keymaps WHERE is_active=1").fetchall()
+        _keymap_cache["by_key"] = {r['input_key']: r for r in rows}
+        _keymap_cache["generation"] = generation
+        _keymap_cache["checked_at"] = time.time()
+
+def invalidate_keymap_cache():
+    """Gọi sau khi Admin ghi vào keymaps: worker hiện tại nạp lại ngay ở lần tra cứu kế tiếp."""
+    _keymap_cache["generation"] = None
+
+def _refresh_keymap_cache_if_stale():
+    now = time.time()
+    if _keymap_cache["generation"] is not None and now - _keymap_cache["checked_at"] < KEYMAP_CACHE_CHECK_INTERVAL:
+        return
+    if _keymap_cache["generation"] is not None:
+        # Kiểm tra rẻ: chỉ đọc 1 dòng config theo PRIMARY KEY
+        with db_read() as con:
+            generation = _read_keymap_generation(con)
+        if generation == _keymap_cache["generation"]:
+            _keymap_cache["checked_at"] = now
+            return
+    load_keymap_cache()
+
 def find_map_by_key(key: str):
-    """Tìm kiếm thông tin sản phẩm dựa trên Input Key"""
-    with db() as con:
-        row = con.execute("SELECT * FROM keymaps WHERE input_key=? AND is_active=1", (key,)).fetchone()
-        return row
+    """Tìm kiếm thông tin sản phẩm dựa trên Input Key (qua cache trong bộ nhớ)"""
+    _refresh_keymap_cache_if_stale()
+    return _keymap_cache["by_key"].get(key)
 
 def require_admin():
     """Middleware kiểm tra quyền Admin"""
@@ -1528,13 +3284,13 @@ def login():
             return response
         else:
             flash("Mật khẩu Admin không chính xác. Vui lòng thử lại.", "error")
-            return render_template_string(LOGIN_TPL)
+            return render_template("login.html")
     
     # Nếu đã login thì chuyển thẳng vào admin
     if request.cookies.get("logged_in") == ADMIN_SECRET:
         return redirect(url_for("admin_index"))
         
-    return render_template_string(LOGIN_TPL)
+    return render_template("login.html")
 
 @app.route("/logout", methods=["POST"])
 def logout():
@@ -1548,29 +3304,9 @@ def admin_index():
     """Trang Dashboard chính"""
     require_admin() 
 
-    with db() as con:
-        # 1. Lấy danh sách Keymaps
-        maps = con.execute("SELECT * FROM keymaps ORDER BY group_name, provider_type, sku, id").fetchall()
-        
-        # Gom nhóm dữ liệu: Website -> Provider -> Key List
-        # SỬ DỤNG LIST ĐỂ ĐẢM BẢO HIỂN THỊ ĐỦ TẤT CẢ KEY
-        grouped_data = {}
-        for key in maps:
-            folder = key['group_name'] or 'DEFAULT' 
-            provider = key['provider_type']
-            
-            if folder not in grouped_data:
-                grouped_data[folder] = {}
-            
-            if provider not in grouped_data[folder]:
-                grouped_data[folder][provider] = [] # Khởi tạo là List
-            
-            grouped_data[folder][provider].append(key) # Append vào list
-        
-        # 2. Lấy danh sách Proxy (Để hiển thị bảng)
-        proxies = con.execute("SELECT * FROM proxies ORDER BY is_live DESC, latency ASC").fetchall()
-
-        # 3. Lấy cấu hình Ping
+    # Cây keymap, bảng proxy và thống kê kho được trình duyệt tải dần qua /admin/api/* (xem ROUTES: DASHBOARD API)
+    with db_read() as con:
+        # Lấy cấu hình Ping
         ping_url = con.execute("SELECT value FROM config WHERE key='ping_url'").fetchone()
         ping_int = con.execute("SELECT value FROM config WHERE key='ping_interval'").fetchone()
         ping_config = {
@@ -1578,26 +3314,114 @@ def admin_index():
             "interval": ping_int['value'] if ping_int else 300
         }
 
-        # 4. Lấy thống kê Local Stock
-        stock_rows = con.execute("SELECT group_name, COUNT(*) as cnt FROM local_stock GROUP BY group_name").fetchall()
-        local_stats = {r['group_name']: r['cnt'] for r in stock_rows}
-        
-        # Tạo danh sách group để gợi ý input
-        local_groups = [r['group_name'] for r in stock_rows]
-
     # Lấy setting giao diện từ Cookie
     effect = request.cookies.get('admin_effect', 'astronaut')
     mode = request.cookies.get('admin_mode', 'dark') 
     
-    return render_template_string(ADMIN_TPL, 
-                                  grouped_data=grouped_data, 
-                                  proxies=proxies, 
-                                  current_proxy=CURRENT_PROXY_STRING, 
-                                  ping=ping_config, 
-                                  local_stats=local_stats,
-                                  local_groups=local_groups,
-                                  effect=effect,
-                                  mode=mode)
+    return render_template("admin.html", 
+                           current_proxy=CURRENT_PROXY_STRING, 
+                           ping=ping_config, 
+                           effect=effect,
+                           mode=mode)
+
+# ------------------------------------------------------------------------------
+# ROUTES: DASHBOARD API (JSON, PHÂN TRANG) - dashboard chỉ tải phần đang xem
+# ------------------------------------------------------------------------------
+# Tóm tắt số key theo Website -> Provider, tính lại khi keymap_generation đổi.
+_keymap_group_summary = {"generation": None, "items": []}
+
+def _page_limit() -> int:
+    try: limit = int(request.args.get("limit", DASHBOARD_PAGE_SIZE))
+    except ValueError: limit = DASHBOARD_PAGE_SIZE
+    return max(1, min(limit, 1000))
+
+def _page_offset() -> int:
+    try: return max(0, int(request.args.get("offset", "0")))
+    except ValueError: return 0
+
+def get_keymap_group_summary() -> list:
+    """
+    [{group, providers: {provider: số key}, total}] theo thứ tự group, đọc 1 lần quét chỉ mục (group, provider).
+    Key không có group (NULL) và group rỗng ('') gộp chung 1 thư mục DEFAULT với group = "".
+    """
+    with db_read() as con:
+        generation = _read_keymap_generation(con)
+        if _keymap_group_summary["generation"] == generation:
+            return _keymap_group_summary["items"]
+        items, by_group = [], {}
+        for row in con.execute("SELECT group_name, provider_type, COUNT(*) AS cnt FROM keymaps GROUP BY group_name, provider_type"):
+            group = row['group_name'] or ""
+            entry = by_group.get(group)
+            if entry is None:
+                entry = by_group[group] = {"group": group, "providers": {}, "total": 0}
+                items.append(entry)
+            providers = entry["providers"]
+            providers[row['provider_type']] = providers.get(row['provider_type'], 0) + row['cnt']
+            entry["total"] += row['cnt']
+    _keymap_group_summary.update({"generation": generation, "items": items})
+    return items
+
+@app.route("/admin/api/keymap-groups")
+def admin_api_keymap_groups():
+    """Danh sách Website (kèm số key theo Provider), phân trang bằng offset."""
+    require_admin()
+    items = get_keymap_group_summary()
+    offset, limit = _page_offset(), _page_limit()
+    next_offset = offset + limit if offset + limit < len(items) else None
+    return jsonify({"items": items[offset:offset + limit], "next_offset": next_offset, "total": len(items)})
+
+@app.route("/admin/api/keymaps")
+def admin_api_keymaps():
+    """
+    Key của 1 Website + Provider, sắp theo (sku, id), phân trang keyset qua after_sku/after_id.
+    group rỗng hoặc không truyền = thư mục DEFAULT (group NULL lẫn ''): 2 khoảng chỉ mục được đọc riêng rồi trộn theo (sku, id).
+    """
+    require_admin()
+    group = request.args.get("group")
+    provider = request.args.get("provider", "")
+    try: after_id = int(request.args.get("after_id", "0"))
+    except ValueError: after_id = 0
+    after_sku = request.args.get("after_sku", "")
+    limit = _page_limit()
+    with db_read() as con:
+        rows = []
+        for group_value in ((group,) if group else (None, "")):
+            rows += con.execute("""
+                SELECT id, sku, input_key, product_id, is_active, base_url FROM keymaps
+                WHERE group_name IS ? AND provider_type=? AND (sku, id) > (?, ?)
+                ORDER BY sku, id LIMIT ?
+            """, (group_value, provider, after_sku, after_id, limit + 1)).fetchall()
+    if not group:
+        rows = sorted(rows, key=lambda r: (r['sku'], r['id']))[:limit + 1]
+    items = [dict(r) for r in rows[:limit]]
+    next_cursor = {"sku": items[-1]["sku"], "id": items[-1]["id"]} if len(rows) > limit else None
+    return jsonify({"items": items, "next": next_cursor})
+
+@app.route("/admin/api/proxies")
+def admin_api_proxies():
+    """Bảng proxy (sống trước, nhanh trước), phân trang bằng offset."""
+    require_admin()
+    offset, limit = _page_offset(), _page_limit()
+    with db_read() as con:
+        rows = con.execute("SELECT id, proxy_string, is_live, latency FROM proxies ORDER BY is_live DESC, latency, id LIMIT ? OFFSET ?",
+                           (limit + 1, offset)).fetchall()
+    return jsonify({"items": [dict(r) for r in rows[:limit]],
+                    "next_offset": offset + limit if len(rows) > limit else None,
+                    "current": CURRENT_PROXY_STRING})
+
+@app.route("/admin/api/local-stock/stats")
+def admin_api_local_stock_stats():
+    """Tồn kho theo nhóm (từ bảng đếm), phân trang keyset theo tên nhóm qua after."""
+    require_admin()
+    after, limit = request.args.get("after"), _page_limit()
+    with db_read() as con:
+        if after is None:
+            rows = con.execute("SELECT group_name, cnt FROM local_stock_counts ORDER BY group_name LIMIT ?", (limit + 1,)).fetchall()
+        else:
+            rows = con.execute("SELECT group_name, cnt FROM local_stock_counts WHERE group_name > ? ORDER BY group_name LIMIT ?",
+                               (after, limit + 1)).fetchall()
+    items = [{"group": r['group_name'], "count": r['cnt']} for r in rows[:limit]]
+    return jsonify({"items": items, "next": items[-1]["group"] if len(rows) > limit else None})
 
 # ------------------------------------------------------------------------------
 # ROUTES: QUẢN LÝ KEYMAP
@@ -1638,6 +3462,7 @@ def admin_add_keymap():
                   is_active=1
             """, (group_name, sku, input_key, product_id, api_key, provider_type, base_url))
             con.commit()
+        invalidate_keymap_cache()
         flash(f"Đã lưu key '{input_key}' thành công!", "success")
     except Exception as e:
         flash(f"Lỗi Database: {e}", "error")
@@ -1673,6 +3498,7 @@ def admin_add_keymap_bulk():
                 except:
                     pass
         con.commit()
+    invalidate_keymap_cache()
     flash(f"Đã thêm {cnt} key hàng loạt vào nhóm '{grp}'", "success")
     return redirect(url_for("admin_index"))
 
@@ -1682,6 +3508,7 @@ def admin_delete_key(kmid):
     with db() as con:
         con.execute("DELETE FROM keymaps WHERE id=?", (kmid,))
         con.commit()
+    invalidate_keymap_cache()
     flash("Đã xóa key thành công.", "success")
     return redirect(url_for("admin_index"))
 
@@ -1694,6 +3521,7 @@ def admin_toggle_key(kmid):
             new_val = 0 if row['is_active'] else 1
             con.execute("UPDATE keymaps SET is_active=? WHERE id=?", (new_val, kmid))
             con.commit()
+    invalidate_keymap_cache()
     return redirect(url_for("admin_index"))
 
 
@@ -1711,71 +3539,144 @@ def admin_local_stock_add():
         flash("Thiếu tên Group.", "error")
         return redirect(url_for("admin_index") + "#local-stock")
     
-    lines = []
-    # Ưu tiên đọc file TXT
+    skip_duplicates = request.form.get("skip_duplicates") == "1"
+    lines = None
+    # Ưu tiên đọc file TXT (đọc dạng stream từng dòng)
     if file and file.filename:
-        try:
-            lines = file.read().decode('utf-8', errors='ignore').splitlines()
-        except Exception as e:
-            flash(f"Lỗi đọc file: {e}", "error")
-            return redirect(url_for("admin_index") + "#local-stock")
+        lines = iter_upload_lines(file)
     # Nếu không có file thì đọc từ ô text
     elif content:
         lines = content.split('\n')
     
-    count = 0
-    if lines:
-        with db() as con:
-            now = get_vn_time() # Dùng giờ Việt Nam
-            for line in lines:
-                line = line.strip()
-                if line:
-                    con.execute("INSERT INTO local_stock(group_name, content, added_at) VALUES(?,?,?)", (grp, line, now))
-                    count += 1
-            con.commit()
+    stats = {"inserted": 0, "skipped": 0, "duplicates": 0}
+    if lines is not None:
+        try:
+            stats = import_local_stock_lines(grp, lines, skip_duplicates)
+        except Exception as e:
+            flash(f"Lỗi nhập kho: {e}", "error")
+            return redirect(url_for("admin_index") + "#local-stock")
         
-    flash(f"Đã thêm {count} dòng vào kho '{grp}'.", "success")
+    flash(f"Đã thêm {stats['inserted']} dòng vào kho '{grp}' (bỏ qua {stats['skipped']} dòng trống, "
+          f"{stats['duplicates']} dòng trùng{' - đã loại' if skip_duplicates else ''}).", "success")
     return redirect(url_for("admin_index") + "#local-stock")
 
+@app.route("/admin/local-stock/add/progress")
+def admin_local_stock_add_progress():
+    """Tiến độ nhập kho theo nhóm (JSON)."""
+    require_admin()
+    grp = request.args.get("group")
+    if grp:
+        return jsonify(get_import_progress(grp))
+    return jsonify(get_import_progress())
+
 @app.route("/admin/local-stock/view")
 def admin_local_stock_view():
+    """
+    Xem kho theo trang (keyset trên (group_name, id)): after = id cuối trang trước, before = id đầu trang sau,
+    start = số thứ tự bắt đầu. Tìm kiếm dùng FTS5 trigram, quay về LIKE nếu không có FTS hoặc từ khóa < 3 ký tự.
+    """
     require_admin()
     grp = request.args.get("group")
     query = request.args.get("q", "").strip() # Lấy từ khóa tìm kiếm
-    
-    with db() as con:
-        if query:
+    after_id = request.args.get("after", type=int)
+    before_id = request.args.get("before", type=int)
+    start = max(request.args.get("start", 0, type=int), 0)
+    page_size = STOCK_VIEW_PAGE_SIZE
+
+    if before_id is not None:
+        id_cond, order, cursor_id = "s.id<?", "DESC", before_id
+    else:
+        id_cond, order, cursor_id = "s.id>?", "ASC", after_id or 0
+
+    matched = None
+    with db_read() as con:
+        if query and stock_fts_available and len(query) >= 3:
+            # Tìm kiếm bằng chỉ mục FTS5 (cụm từ trong ngoặc kép = khớp chuỗi con).
+            # Lưu ý chi phí: chỉ mục FTS chung cho mọi nhóm, không lọc được theo group_name. Planner hoặc duyệt nhóm theo id
+            # rồi tra FTS theo rowid (từ khóa hiếm trong nhóm lớn -> đi gần hết nhóm), hoặc liệt kê mọi dòng khớp của tất cả
+            # các nhóm rồi mới lọc (từ khóa phổ biến ở nhóm khác vẫn tốn thời gian). Cả 2 đều dừng khi đủ 1 trang.
+            match = '"' + query.replace('"', '""') + '"'
+            search_sql = "FROM local_stock_fts f JOIN local_stock s ON s.id = f.rowid WHERE local_stock_fts MATCH ? AND s.group_name=?"
+            search_args = (match, grp)
+        elif query:
             # Tìm kiếm gần đúng (LIKE)
-            items = con.execute("SELECT * FROM local_stock WHERE group_name=? AND content LIKE ?", (grp, f"%{query}%")).fetchall()
+            search_sql = "FROM local_stock s WHERE s.group_name=? AND s.content LIKE ?"
+            search_args = (grp, f"%{query}%")
+        if query:
+            items = con.execute(f"SELECT s.* {search_sql} AND {id_cond} ORDER BY s.id {order} LIMIT ?",
+                                (*search_args, cursor_id, page_size + 1)).fetchall()
+            # Số dòng khớp, đếm tối đa STOCK_SEARCH_COUNT_LIMIT (+1 để biết còn nhiều hơn)
+            matched = con.execute(f"SELECT COUNT(*) FROM (SELECT 1 {search_sql} LIMIT ?)",
+                                  (*search_args, STOCK_SEARCH_COUNT_LIMIT + 1)).fetchone()[0]
         else:
-            items = con.execute("SELECT * FROM local_stock WHERE group_name=?", (grp,)).fetchall()
-            
-    return render_template_string(STOCK_VIEW_TPL, group=grp, items=items, request=request)
+            items = con.execute(f"SELECT s.* FROM local_stock s WHERE s.group_name=? AND {id_cond} ORDER BY s.id {order} LIMIT ?",
+                                (grp, cursor_id, page_size + 1)).fetchall()
+
+    # Lấy dư 1 dòng để biết còn trang tiếp theo (theo chiều đang duyệt) hay không
+    has_more = len(items) > page_size
+    items = items[:page_size]
+    if before_id is not None:
+        items.reverse()
+        has_next, has_prev = True, has_more
+    else:
+        has_next, has_prev = has_more, after_id is not None and start > 0
+
+    pager = {
+        "start": start,
+        "next_after": items[-1]['id'] if items and has_next else None,
+        "prev_before": items[0]['id'] if items and has_prev else None,
+        "prev_start": max(start - page_size, 0),
+        "next_start": start + len(items),
+    }
+    total = get_local_stock_count(grp)
+    if matched is not None and matched > STOCK_SEARCH_COUNT_LIMIT:
+        matched = f"{STOCK_SEARCH_COUNT_LIMIT}+"
+    return render_template("stock_view.html", group=grp, items=items, total=total, matched=matched, query=query, pager=pager, request=request)
 
 @app.route("/admin/local-stock/download")
 def admin_local_stock_download():
+    """
+    Tải kho dạng file .txt (stream, RAM không phụ thuộc kích thước kho).
+    Tham số tùy chọn: gzip=1 (nén), from / to (lọc theo added_at, dạng "YYYY-MM-DD HH:MM:SS").
+    """
     require_admin()
     grp = request.args.get("group")
-    with db() as con:
-        rows = con.execute("SELECT content FROM local_stock WHERE group_name=?", (grp,)).fetchall()
-    
-    # Xuất ra file .txt, mỗi dòng là 1 content
-    out = "\n".join([r['content'] for r in rows])
-    resp = make_response(out)
-    resp.headers["Content-Disposition"] = f"attachment; filename=stock_{grp}.txt"
-    resp.headers["Content-Type"] = "text/plain"
+    added_from = request.args.get("from", "").strip() or None
+    added_to = request.args.get("to", "").strip() or None
+    use_gzip = request.args.get("gzip") == "1"
+
+    def generate_text():
+        # Xuất ra file .txt, mỗi dòng là 1 content
+        first = True
+        for rows in iter_local_stock_rows(grp, added_from, added_to):
+            out = "\n".join(r['content'] for r in rows)
+            yield (out if first else "\n" + out).encode('utf-8')
+            first = False
+
+    def generate_gzip():
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) # 31 = định dạng gzip
+        for chunk in generate_text():
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    filename = f"stock_{grp}.txt" + (".gz" if use_gzip else "")
+    resp = Response(stream_with_context(generate_gzip() if use_gzip else generate_text()),
+                    mimetype="application/gzip" if use_gzip else "text/plain")
+    resp.headers["Content-Disposition"] = f"attachment; filename={filename}"
     return resp
 
 @app.route("/admin/local-history/view")
 def admin_local_history_view():
     require_admin()
     grp = request.args.get("group")
-    with db() as con:
+    with db_read() as con:
         if grp:
             items = con.execute("SELECT * FROM local_history WHERE group_name=? ORDER BY id DESC LIMIT 500", (grp,)).fetchall()
         else:
             items = con.execute("SELECT * FROM local_history ORDER BY id DESC LIMIT 500").fetchall()
-    return render_template_string(HISTORY_VIEW_TPL, group=grp, items=items)
+    return render_template("history_view.html", group=grp, items=items)
 
 @app.route("/admin/local-stock/dedup", methods=["POST"])
 def admin_local_stock_dedup():
@@ -1817,6 +3718,20 @@ def admin_local_stock_clear():
     flash(f"Đã xóa sạch kho '{grp}'.", "success")
     return redirect(url_for("admin_index") + "#local-stock")
 
+@app.route("/admin/local-stock/recount", methods=["POST"])
+def admin_local_stock_recount():
+    """Kiểm tra bảng đếm tồn kho, dựng lại từ đầu nếu bị lệch."""
+    require_admin()
+    with db() as con:
+        mismatches = check_local_stock_counts(con)
+        if mismatches:
+            rebuild_local_stock_counts(con)
+    if mismatches:
+        flash(f"Đã sửa bảng đếm cho {len(mismatches)} nhóm bị lệch.", "success")
+    else:
+        flash("Bảng đếm tồn kho đã khớp, không cần sửa.", "success")
+    return redirect(url_for("admin_index") + "#local-stock")
+
 # ROUTE MỚI: XỬ LÝ LẤY HÀNG THỦ CÔNG & HIỂN THỊ KẾT QUẢ
 @app.route("/admin/local-stock/fetch-manual", methods=["POST"])
 def admin_local_stock_fetch_manual():
@@ -1843,7 +3758,7 @@ def admin_local_stock_fetch_manual():
     content_str = "\n".join(content_list)
     
     # Render ra trang kết quả (mở tab mới)
-    return render_template_string(FETCH_RESULT_TPL, content=content_str, count=len(items), group=grp)
+    return render_template("fetch_result.html", content=content_str, count=len(items), group=grp)
 
 
 # ------------------------------------------------------------------------------
@@ -1865,6 +3780,7 @@ def admin_add_proxy():
         
         if not CURRENT_PROXY_STRING:
             select_best_available_proxy(con)
+    refresh_proxy_routes()
             
     flash(f"Đã thêm {count} proxy vào hệ thống.", "success")
     return redirect(url_for("admin_index"))
@@ -1875,6 +3791,7 @@ def admin_delete_proxy():
     with db() as con:
         con.execute("DELETE FROM proxies WHERE id=?", (request.form.get("id"),))
         con.commit()
+    refresh_proxy_routes()
     return redirect(url_for("admin_index"))
 
 
@@ -1896,6 +3813,215 @@ def admin_save_ping():
     return redirect(url_for("admin_index"))
 
 
+# ------------------------------------------------------------------------------
+# ROUTES: THỐNG KÊ HIỆU NĂNG (PERFORMANCE STATS)
+# ------------------------------------------------------------------------------
+@app.route("/admin/catalog-cache/stats")
+def admin_catalog_cache_stats():
+    require_admin()
+    return jsonify(get_catalog_cache_stats())
+
+@app.route("/admin/proxy-routes/stats")
+def admin_proxy_route_stats():
+    """Độ trễ EWMA, tỉ lệ lỗi và số request của từng proxy trong bộ định tuyến."""
+    require_admin()
+    return jsonify(get_proxy_route_stats())
+
+@app.route("/admin/backup/stats")
+def admin_backup_stats():
+    """Thời gian chạy & dung lượng của lần backup gần nhất."""
+    require_admin()
+    return jsonify({**last_backup_info, "chain": load_backup_manifest()})
+
+
+# ------------------------------------------------------------------------------
+# ROUTES: METRICS (PROMETHEUS)
+# ------------------------------------------------------------------------------
+@app.before_request
+def _metrics_start_timer():
+    g.metrics_started = time.perf_counter()
+
+@app.after_request
+def _metrics_record_request(response):
+    started = g.get("metrics_started")
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "<unmatched>"
+        observe("http_request_duration_seconds", time.perf_counter() - started, route=route, method=request.method)
+        inc_counter("http_requests_total", route=route, method=request.method, status=response.status_code)
+    return response
+
+def _proxy_label(proxy_string: str) -> str:
+    """Chỉ giữ ip:port (bỏ user:pass) khi đưa proxy vào nhãn metrics."""
+    return ":".join(proxy_string.split(":")[:2])
+
+def collect_metric_gauges() -> list:
+    """Các giá trị tức thời đọc lúc scrape: proxy, tồn kho, cache, trạng thái khởi động."""
+    gauges = [("app_ready", {}, 1 if startup_state["ready"] else 0)]
+    for row in get_proxies_from_db():
+        label = {"proxy": _proxy_label(row['proxy_string'])}
+        gauges.append(("proxy_live", label, row['is_live']))
+        gauges.append(("proxy_probe_latency_seconds", label, row['latency']))
+    for proxy_string, route in get_proxy_route_stats()["routes"].items():
+        label = {"proxy": _proxy_label(proxy_string)}
+        gauges.append(("proxy_ewma_latency_seconds", label, route["latency"]))
+        gauges.append(("proxy_ewma_error_rate", label, route["error_rate"]))
+    with db_read() as con:
+        for row in con.execute("SELECT group_name, cnt FROM local_stock_counts"):
+            gauges.append(("local_stock_count", {"group": row['group_name']}, row['cnt']))
+    cache = get_catalog_cache_stats()
+    gauges.append(("catalog_cache_size", {}, cache["size"]))
+    for k in ("hits", "misses", "shared", "errors"):
+        gauges.append((f"catalog_cache_{k}_total", {}, cache[k]))
+    for k in ("requests", "hedged", "hedge_wins"):
+        gauges.append((f"catalog_hedge_{k}_total", {}, cache["hedge"][k]))
+    return gauges
+
+@app.route("/metrics")
+def metrics():
+    if not METRICS_ENABLED:
+        abort(404)
+    if request.cookies.get("logged_in") != ADMIN_SECRET:
+        # Nhãn metrics chứa ip:port proxy và tên nhóm kho -> không bao giờ mở công khai
+        if not METRICS_TOKEN:
+            abort(404)
+        token = request.headers.get("Authorization", "").removeprefix("Bearer ").strip() or request.args.get("token", "")
+        if token != METRICS_TOKEN:
+            abort(401)
+    return Response(render_metrics(collect_metric_gauges()), mimetype="text/plain; version=0.0.4")
+
+
+# ------------------------------------------------------------------------------
+# ROUTES: PROFILING THEO YÊU CẦU
+# ------------------------------------------------------------------------------
+# Kế hoạch profile request: route đích, số request còn lại, pstats cộng dồn, file kết quả.
+# Khi không bật, mỗi request chỉ tốn 1 lần đọc dict trong before_request.
+_profile_plan = {"route": "", "remaining": 0, "total": 0, "stats": None, "file": None}
+_profile_lock = threading.Lock()
+# Chỉ profile 1 request tại một thời điểm (các request song song cùng route được bỏ qua)
+_profile_active = threading.Lock()
+_sampler_state = {"running": False, "file": None}
+
+def _profile_path(suffix: str) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    return os.path.join(PROFILE_DIR, f"{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}{suffix}")
+
+def arm_request_profiler(route: str, count: int):
+    """Profile (cProfile) count request kế tiếp của route, gộp kết quả vào 1 file .pstats."""
+    with _profile_lock:
+        _profile_plan.update({"route": route, "remaining": count, "total": count, "stats": None, "file": None})
+
+@app.before_request
+def _profile_before_request():
+    if not _profile_plan["remaining"]:
+        return
+    if not request.url_rule or request.url_rule.rule != _profile_plan["route"]:
+        return
+    if not _profile_active.acquire(blocking=False):
+        return
+    g.profiler = cProfile.Profile()
+    g.profiler.enable()
+
+@app.teardown_request
+def _profile_teardown_request(exc):
+    profiler = g.pop("profiler", None)
+    if profiler is None:
+        return
+    profiler.disable()
+    _profile_active.release()
+    with _profile_lock:
+        if _profile_plan["remaining"] <= 0:
+            return
+        if _profile_plan["stats"] is None:
+            _profile_plan["stats"] = pstats.Stats(profiler)
+        else:
+            _profile_plan["stats"].add(profiler)
+        _profile_plan["remaining"] -= 1
+        if _profile_plan["remaining"] == 0:
+            path = _profile_path(f"_{_profile_plan['route'].strip('/').replace('/', '_') or 'root'}.pstats")
+            _profile_plan["stats"].dump_stats(path)
+            _profile_plan["stats"] = None
+            _profile_plan["file"] = os.path.basename(path)
+            print(f"INFO: Đã ghi profile {_profile_plan['total']} request {_profile_plan['route']} vào {path}")
+
+def _frame_stack(frame) -> str:
+    """Chuỗi stack dạng collapsed (gốc trước, lá sau) cho flamegraph."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+def run_stack_sampler(seconds: float, interval: float):
+    """Lấy mẫu stack mọi thread qua sys._current_frames trong khoảng thời gian cho trước, ghi file .folded."""
+    counts = {}
+    me = threading.get_ident()
+    names = {t.ident: t.name for t in threading.enumerate()}
+    deadline = time.time() + seconds
+    try:
+        while time.time() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = f"{names.get(ident, ident)};{_frame_stack(frame)}"
+                counts[stack] = counts.get(stack, 0) + 1
+            time.sleep(interval)
+            if len(names) != threading.active_count():
+                names = {t.ident: t.name for t in threading.enumerate()}
+        path = _profile_path(".folded")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, n in sorted(counts.items(), key=lambda kv: -kv[1]):
+                f.write(f"{stack} {n}\n")
+        _sampler_state["file"] = os.path.basename(path)
+        print(f"INFO: Đã ghi {sum(counts.values())} mẫu stack vào {path}")
+    finally:
+        _sampler_state["running"] = False
+
+@app.route("/admin/profile")
+def admin_profile_status():
+    """Trạng thái profiling và danh sách file kết quả."""
+    require_admin()
+    files = sorted(os.listdir(PROFILE_DIR)) if os.path.isdir(PROFILE_DIR) else []
+    with _profile_lock:
+        plan = {k: v for k, v in _profile_plan.items() if k != "stats"}
+    return jsonify({"requests": plan, "sampler": dict(_sampler_state), "files": files})
+
+@app.route("/admin/profile/requests", methods=["POST"])
+def admin_profile_requests():
+    """Profile N request kế tiếp của 1 route (vd. route=/fetch&count=50)."""
+    require_admin()
+    route = request.form.get("route", "").strip()
+    try: count = int(request.form.get("count", "20"))
+    except ValueError: count = 0
+    if not route or count <= 0:
+        return jsonify({"error": "Cần route và count > 0"}), 400
+    arm_request_profiler(route, count)
+    return jsonify({"armed": route, "count": count})
+
+@app.route("/admin/profile/sample", methods=["POST"])
+def admin_profile_sample():
+    """Lấy mẫu stack toàn tiến trình trong seconds giây (mặc định 10s, mỗi 10ms)."""
+    require_admin()
+    try:
+        seconds = min(float(request.form.get("seconds", "10")), 300.0)
+        interval = max(float(request.form.get("interval_ms", "10")) / 1000, 0.001)
+    except ValueError:
+        return jsonify({"error": "seconds/interval_ms không hợp lệ"}), 400
+    if _sampler_state["running"]:
+        return jsonify({"error": "Đang lấy mẫu"}), 409
+    _sampler_state.update({"running": True, "file": None})
+    threading.Thread(target=run_stack_sampler, args=(seconds, interval), daemon=True).start()
+    return jsonify({"sampling_seconds": seconds, "interval": interval})
+
+@app.route("/admin/profile/download/<name>")
+def admin_profile_download(name):
+    require_admin()
+    path = os.path.join(PROFILE_DIR, os.path.basename(name))
+    if not os.path.isfile(path):
+        abort(404)
+    return send_file(os.path.abspath(path), as_attachment=True, download_name=os.path.basename(name))
+
+
 # ------------------------------------------------------------------------------
 # ROUTES: BACKUP & RESTORE
 # ------------------------------------------------------------------------------
@@ -1903,37 +4029,41 @@ def admin_save_ping():
 def admin_backup_download():
     require_admin()
     perform_backup_to_file()
-    if os.path.exists(AUTO_BACKUP_FILE):
-        with open(AUTO_BACKUP_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            data['export_time'] = get_vn_time()
-            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            response = jsonify(data)
-            response.headers['Content-Disposition'] = f'attachment; filename=full_backup_{timestamp}.json'
-            return response
+    path = get_auto_backup_path()
+    if os.path.exists(path):
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        suffix = ".json.gz" if path.endswith(".gz") else ".json"
+        return send_file(os.path.abspath(path), as_attachment=True, download_name=f"full_backup_{timestamp}{suffix}",
+                         mimetype="application/gzip" if suffix.endswith(".gz") else "application/json")
     return "Chưa có dữ liệu backup.", 404
 
+@app.route("/admin/backup/restore-chain", methods=["POST"])
+def admin_backup_restore_chain():
+    """Khôi phục từ chuỗi backup trên đĩa (bản đầy đủ + các delta)."""
+    require_admin()
+    try:
+        stats = restore_backup_chain()
+        mark_data_ready("restored")
+        flash(f"Restore chuỗi backup thành công ({stats['deltas']} delta, {stats['changes']} thay đổi).", "success")
+    except Exception as e:
+        flash(f"Lỗi khôi phục: {e}", "error")
+    return redirect(url_for("admin_index"))
+
 @app.route("/admin/backup/upload", methods=["POST"])
 def admin_backup_upload():
     require_admin()
     file = request.files.get('backup_file')
-    if file and file.filename.endswith('.json'):
+    if file and file.filename.endswith(('.json', '.json.gz')):
         try:
-            data = json.load(file)
-            with db() as con:
-                con.execute("DELETE FROM keymaps"); con.execute("DELETE FROM proxies"); con.execute("DELETE FROM local_stock")
-                
-                kms = data.get('keymaps', []) if isinstance(data, dict) else data
-                pxs = data.get('proxies', []) if isinstance(data, dict) else []
-                lcs = data.get('local_stock', []) if isinstance(data, dict) else []
-                cfg = data.get('config', {}) if isinstance(data, dict) else {}
-
-                for k in kms: con.execute("INSERT INTO keymaps(sku,input_key,product_id,is_active,group_name,provider_type,base_url,api_key) VALUES(?,?,?,?,?,?,?,?)", (k.get('sku'), k.get('input_key'), k.get('product_id'), k.get('is_active',1), k.get('group_name'), k.get('provider_type'), k.get('base_url'), k.get('api_key')))
-                for p in pxs: con.execute("INSERT OR IGNORE INTO proxies(proxy_string, is_live, latency, last_checked) VALUES(?,?,?,?)", (p.get('proxy_string'), 0, 9999.0, get_vn_time()))
-                for l in lcs: con.execute("INSERT INTO local_stock(group_name, content, added_at) VALUES(?,?,?)", (l.get('group_name'), l.get('content'), l.get('added_at')))
-                for k, v in cfg.items(): con.execute("INSERT OR REPLACE INTO config(key,value) VALUES(?,?)", (k, str(v)))
-                con.commit()
-            flash("Restore thành công", "success")
+            if file.filename.endswith('.gz'):
+                stream = gzip.open(file.stream, 'rt', encoding='utf-8')
+            else:
+                stream = io.TextIOWrapper(file.stream, encoding='utf-8')
+            stats = restore_backup_stream(stream, mode="upload")
+            invalidate_keymap_cache()
+            reset_backup_chain()
+            mark_data_ready("restored")
+            flash(f"Restore thành công ({stats['rows']} dòng trong {stats['seconds']}s, {stats['rows_per_sec']} dòng/s)", "success")
         except Exception as e: flash(f"Lỗi khôi phục: {e}", "error")
     return redirect(url_for("admin_index"))
 
@@ -1946,14 +4076,46 @@ def admin_backup_upload():
 # ------------------------------------------------------------------------------
 # ==============================================================================
 
+# Các route trả dữ liệu kho: bị chặn (503) khi khởi động chưa xong hoặc restore thất bại
+DATA_ENDPOINTS = {"stock", "stock_batch", "fetch", "fetch_batch"}
+
+@app.before_request
+def _require_ready():
+    if request.endpoint in DATA_ENDPOINTS and not startup_state["ready"]:
+        resp = jsonify({"error": "Hệ thống đang khởi động, vui lòng thử lại sau", "phase": startup_state["phase"]})
+        resp.headers["Retry-After"] = "5"
+        return resp, 503
+
 @app.route("/stock")
 def stock():
     key = request.args.get("key", "").strip()
-    with db() as con: row = find_map_by_key(key)
+    row = find_map_by_key(key)
     if not row: return jsonify({"sum": 0})
     if row['provider_type'] == 'local': return jsonify({"sum": get_local_stock_count(row['group_name'])})
     return stock_mail72h_format(row) 
 
+def _batch_request_keys() -> list:
+    """
+    Đọc danh sách key của request batch: JSON ["k1", "k2"] hoặc {"keys": [...]},
+    hoặc tham số keys=k1,k2 (lặp lại được). Bỏ key rỗng/trùng, giữ thứ tự.
+    """
+    data = request.get_json(silent=True) if request.is_json else None
+    if isinstance(data, dict):
+        data = data.get("keys")
+    if isinstance(data, list):
+        raw = [str(k) for k in data]
+    else:
+        raw = [k for v in request.values.getlist("keys") for k in v.split(",")]
+    return list(dict.fromkeys(k.strip() for k in raw if k.strip()))
+
+@app.route("/stock/batch", methods=["GET", "POST"])
+def stock_batch():
+    """Tồn kho nhiều key trong 1 request: trả về {key: sum}, cùng ngữ nghĩa với /stock."""
+    keys = _batch_request_keys()
+    if len(keys) > BATCH_MAX_KEYS:
+        return jsonify({"error": f"Tối đa {BATCH_MAX_KEYS} key mỗi request"}), 400
+    return jsonify(batch_stock_sums(keys))
+
 @app.route("/fetch")
 def fetch():
     key = request.args.get("key", "").strip(); qty_s = request.args.get("quantity", "").strip()
@@ -1964,10 +4126,59 @@ def fetch():
     if row['provider_type']=='local': return jsonify(fetch_local_stock(row['group_name'], qty))
     return fetch_mail72h_format(row, qty)
 
+def _batch_fetch_items() -> dict:
+    """
+    Đọc danh sách (key, quantity) của request batch: JSON [{"key": k, "quantity": n}] / [[k, n]] / {"items": [...]},
+    hoặc các tham số key=...&quantity=... lặp lại theo cặp. Key lặp lại được cộng dồn số lượng;
+    số lượng không hợp lệ tính là 0 (key đó trả về [] như /fetch).
+    """
+    data = request.get_json(silent=True) if request.is_json else None
+    if isinstance(data, dict):
+        data = data.get("items")
+    pairs = []
+    if isinstance(data, list):
+        for it in data:
+            if isinstance(it, dict):
+                pairs.append((it.get("key"), it.get("quantity")))
+            elif isinstance(it, (list, tuple)) and len(it) == 2:
+                pairs.append((it[0], it[1]))
+    else:
+        pairs = list(zip(request.values.getlist("key"), request.values.getlist("quantity")))
+
+    items = {}
+    for key, qty in pairs:
+        key = str(key or "").strip()
+        if not key:
+            continue
+        try: qty = int(str(qty).strip())
+        except (TypeError, ValueError): qty = 0
+        items[key] = items.get(key, 0) + max(qty, 0)
+    return items
+
+@app.route("/fetch/batch", methods=["GET", "POST"])
+def fetch_batch():
+    """
+    Lấy hàng nhiều key trong 1 request: trả về {key: [{"product": ...}]}.
+    Hàng local được lấy tất cả hoặc không: thiếu hàng ở bất kỳ key nào -> 409 kèm số còn lại, không key nào bị trừ kho.
+    """
+    items = _batch_fetch_items()
+    if len(items) > BATCH_MAX_KEYS:
+        return jsonify({"error": f"Tối đa {BATCH_MAX_KEYS} key mỗi request"}), 400
+    result, shortages = batch_fetch(items)
+    if shortages:
+        return jsonify({"error": "Không đủ hàng trong kho, không key nào được lấy", "shortages": shortages}), 409
+    return jsonify(result)
+
 @app.route("/health")
 def health():
+    """Liveness: tiến trình còn sống và nhận request."""
     return "OK", 200
 
+@app.route("/health/ready")
+def health_ready():
+    """Readiness: restore dữ liệu & quét proxy lúc khởi động đã xong (503 nếu chưa)."""
+    return jsonify(startup_state), (200 if startup_state["ready"] else 503)
+
 
 # ==============================================================================
 # ------------------------------------------------------------------------------
@@ -1977,9 +4188,77 @@ def health():
 # ------------------------------------------------------------------------------
 # ==============================================================================
 
+def restore_startup_proxy():
+    """Logic khôi phục Proxy (chỉ chạy 1 lần khi khởi động)."""
+    with db() as con_startup:
+        manual_proxy_choice = load_selected_proxy_from_db(con_startup)
+    if manual_proxy_choice:
+        print(f"INFO: Đang khôi phục proxy đã lưu: {manual_proxy_choice}")
+        is_live, latency = check_proxy_live(manual_proxy_choice)
+        if is_live:
+            set_current_proxy_by_string(manual_proxy_choice)
+            update_proxy_state(manual_proxy_choice, is_live, latency)
+            refresh_proxy_routes()
+        else:
+            print("WARNING: Proxy đã lưu bị chết. Đang quét lại...")
+            run_initial_proxy_scan_and_select()
+    else:
+        run_initial_proxy_scan_and_select()
+
+def mark_data_ready(reason: str = "ready"):
+    """Mở lại các route dữ liệu: sau khi khởi động xong, hoặc sau 1 lần restore thủ công thành công."""
+    startup_state["error"] = None
+    startup_state["phase"] = reason
+    if not startup_state["ready"]:
+        startup_state["ready_seconds"] = round(time.time() - BOOT_STARTED_AT, 3)
+        startup_state["ready"] = True
+
+def run_startup_tasks():
+    """
+    Các bước khởi động chậm: restore từ backup, tạo chỉ mục, quét proxy.
+    - Restore lỗi được thử lại STARTUP_RESTORE_RETRIES lần; vẫn lỗi thì /stock, /fetch trả 503 cho đến khi
+      admin restore thành công (upload hoặc chuỗi backup), tránh bán hàng từ DB trống.
+    - Lỗi tạo chỉ mục / quét proxy không chặn (chỉ chậm hơn; luồng kiểm tra proxy sẽ quét lại).
+    """
+    startup_state["error"] = None
+    startup_state["phase"] = "restoring"
+    for attempt in range(STARTUP_RESTORE_RETRIES + 1):
+        try:
+            auto_restore_if_empty()
+            break
+        except Exception as e:
+            startup_state["error"] = str(e)
+            if attempt == STARTUP_RESTORE_RETRIES:
+                startup_state["phase"] = "failed"
+                print(f"STARTUP ERROR: {e}. /stock và /fetch sẽ trả 503 cho đến khi restore thành công.")
+                return
+            delay = STARTUP_RESTORE_RETRY_DELAY * (attempt + 1)
+            print(f"STARTUP ERROR: {e}. Thử lại restore sau {delay}s...")
+            time.sleep(delay)
+    invalidate_keymap_cache()
+
+    startup_state["phase"] = "indexing"
+    try:
+        ensure_db_indexes()
+    except Exception as e:
+        print(f"STARTUP ERROR (Non-critical): Tạo chỉ mục thất bại: {e}")
+
+    startup_state["phase"] = "proxy_scan"
+    try:
+        restore_startup_proxy()
+    except Exception as e:
+        print(f"STARTUP ERROR (Non-critical): {e}")
+
+    mark_data_ready()
+    print(f"INFO: Hệ thống sẵn sàng sau {startup_state['ready_seconds']}s.")
+
 # QUAN TRỌNG: Chạy init_db() ngay khi file được import (để Gunicorn trên Render chạy nó)
 print("INFO: Đang khởi tạo Database...")
 init_db() 
+load_keymap_cache()
+
+if PROFILE_ROUTE and PROFILE_REQUESTS > 0:
+    arm_request_profiler(PROFILE_ROUTE, PROFILE_REQUESTS)
 
 # Khởi động các luồng chạy nền (Proxy checker, Ping, Backup)
 if not proxy_checker_started:
@@ -1989,23 +4268,20 @@ if not ping_service_started:
 if not auto_backup_started:
     start_auto_backup()
 
-# Logic khôi phục Proxy (chỉ chạy 1 lần khi khởi động)
-try:
-    with db() as con_startup:
-        manual_proxy_choice = load_selected_proxy_from_db(con_startup)
-        if manual_proxy_choice:
-            print(f"INFO: Đang khôi phục proxy đã lưu: {manual_proxy_choice}")
-            is_live, latency = check_proxy_live(manual_proxy_choice)
-            if is_live:
-                set_current_proxy_by_string(manual_proxy_choice)
-                update_proxy_state(manual_proxy_choice, is_live, latency)
-            else:
-                print("WARNING: Proxy đã lưu bị chết. Đang quét lại...")
-                run_initial_proxy_scan_and_select()
-        else:
-            run_initial_proxy_scan_and_select()
-except Exception as e:
-    print(f"STARTUP ERROR (Non-critical): {e}")
+if FAST_BOOT:
+    # Dùng ngay proxy đã lưu (chưa kiểm tra), phần còn lại chạy nền
+    try:
+        with db_read() as con_startup:
+            set_current_proxy_by_string(load_selected_proxy_from_db(con_startup))
+        refresh_proxy_routes()
+    except Exception as e:
+        print(f"STARTUP ERROR (Non-critical): {e}")
+    threading.Thread(target=run_startup_tasks, daemon=True).start()
+else:
+    run_startup_tasks()
+
+startup_state["live_seconds"] = round(time.time() - BOOT_STARTED_AT, 3)
+print(f"INFO: Nhận request sau {startup_state['live_seconds']}s (FAST_BOOT={'on' if FAST_BOOT else 'off'}).")
 
 # Block này chỉ chạy khi bạn test trên máy tính (python app.py)
 if __name__ == "__main__":
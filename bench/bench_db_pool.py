@@ -0,0 +1,72 @@
+"""
+Benchmark: mở kết nối SQLite mới mỗi lần gọi (cách cũ) so với pool kết nối theo thread.
+
+Chạy:
+    python bench/bench_db_pool.py [số_lần_gọi] [số_thread]
+
+Script dùng một Database tạm, không đụng tới DB thật.
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+import sqlite3
+
+_tmp_dir = tempfile.mkdtemp(prefix="bench_db_")
+os.environ["DB_PATH"] = os.path.join(_tmp_dir, "bench.db")
+os.environ.setdefault("SECRET_BACKUP_FILE_PATH", os.path.join(_tmp_dir, "none.json"))
+os.environ.setdefault("FAST_BOOT", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as A  # noqa: E402
+
+
+def connect_per_call():
+    """Cách cũ: sqlite3.connect() mới cho mỗi truy vấn, không PRAGMA."""
+    con = sqlite3.connect(A.DB)
+    con.row_factory = sqlite3.Row
+    with con:
+        con.execute("SELECT * FROM keymaps WHERE input_key=? AND is_active=1", ("BENCH_KEY",)).fetchone()
+    con.close()
+
+
+def pooled():
+    with A.db_read() as con:
+        con.execute("SELECT * FROM keymaps WHERE input_key=? AND is_active=1", ("BENCH_KEY",)).fetchone()
+
+
+def run(fn, calls, threads):
+    per_thread = calls // threads
+
+    def worker():
+        for _ in range(per_thread):
+            fn()
+
+    ts = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return per_thread * threads / elapsed
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    with A.db() as con:
+        con.execute(
+            "INSERT OR IGNORE INTO keymaps(sku, input_key, product_id, provider_type) VALUES('BENCH', 'BENCH_KEY', 0, 'local')"
+        )
+
+    print(f"Calls: {calls}, threads: {threads}")
+    for name, fn in (("connect-per-call", connect_per_call), ("thread pool", pooled)):
+        rate = run(fn, calls, threads)
+        print(f"{name:>18}: {rate:10.0f} queries/s")
+
+
+if __name__ == "__main__":
+    main()
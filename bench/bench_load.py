@@ -0,0 +1,131 @@
+"""
+Benchmark tải cho /stock và /fetch (keymap local và mail72h) qua HTTP thật, hoàn toàn offline:
+dựng nhà cung cấp giả lập (bench/fake_provider.py), chạy app bằng server đa luồng của werkzeug
+trên cổng cục bộ, rồi bắn request ở từng mức concurrency. In p50/p95/p99 và số request/giây;
+--json ghi kết quả ra file để so sánh giữa các commit.
+
+Chạy:
+    python bench/bench_load.py [--requests 2000] [--concurrency 1,8,32] [--products 500]
+                               [--latency-ms 20] [--jitter-ms 0] [--scenarios stock-local,...] [--json out.json]
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+_tmp_dir = tempfile.mkdtemp(prefix="bench_load_")
+os.environ["DB_PATH"] = os.path.join(_tmp_dir, "load.db")
+os.environ.setdefault("SECRET_BACKUP_FILE_PATH", os.path.join(_tmp_dir, "none.json"))
+os.environ.setdefault("FAST_BOOT", "0")
+os.environ["ADMIN_SECRET"] = "bench"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import requests  # noqa: E402
+from werkzeug.serving import make_server  # noqa: E402
+
+import app as A  # noqa: E402
+from fake_provider import start_fake_provider  # noqa: E402
+
+SCENARIOS = ["stock-local", "stock-mail72h", "fetch-local", "fetch-mail72h"]
+
+
+def setup_keymaps(base_url, local_lines):
+    with A.db() as con:
+        con.execute("INSERT INTO keymaps(sku, input_key, product_id, is_active, group_name, provider_type, base_url, api_key) "
+                    "VALUES('LOCAL', 'bench-local', '0', 1, 'BENCH', 'local', NULL, NULL)")
+        con.execute("INSERT INTO keymaps(sku, input_key, product_id, is_active, group_name, provider_type, base_url, api_key) "
+                    "VALUES('REMOTE', 'bench-remote', '7', 1, 'REMOTE', 'mail72h', ?, 'bench-key')", (base_url,))
+        con.commit()
+    A.invalidate_keymap_cache()
+    A.import_local_stock_lines("BENCH", (f"user{i}@mail.test|pass{i}" for i in range(local_lines)))
+
+
+def scenario_url(app_url, name):
+    kind, provider = name.split("-")
+    key = "bench-local" if provider == "local" else "bench-remote"
+    if kind == "stock":
+        return f"{app_url}/stock?key={key}"
+    return f"{app_url}/fetch?key={key}&quantity=1"
+
+
+def run_level(url, n_requests, concurrency):
+    local = threading.local()
+
+    def one(_):
+        sess = getattr(local, "sess", None)
+        if sess is None:
+            sess = local.sess = requests.Session()
+        started = time.perf_counter()
+        try:
+            r = sess.get(url, timeout=30)
+            ok = r.status_code == 200 and r.json() not in ([], {"sum": 0})
+        except Exception:
+            ok = False
+        return time.perf_counter() - started, ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(n_requests)))
+    elapsed = time.perf_counter() - started
+    latencies = sorted(latency for latency, _ in results)
+    errors = sum(1 for _, ok in results if not ok)
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] * 1000
+
+    return {"requests": n_requests, "concurrency": concurrency, "errors": errors,
+            "rps": round(n_requests / elapsed, 1), "p50_ms": round(pct(50), 2), "p95_ms": round(pct(95), 2),
+            "p99_ms": round(pct(99), 2), "mean_ms": round(statistics.mean(latencies) * 1000, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load benchmark for /stock and /fetch (offline).")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per scenario and concurrency level")
+    parser.add_argument("--concurrency", default="1,8,32")
+    parser.add_argument("--products", type=int, default=500, help="fake provider catalog size")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="fake provider base latency")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="extra random latency per call")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    levels = [int(c) for c in args.concurrency.split(",") if c]
+    scenarios = [s for s in args.scenarios.split(",") if s]
+    provider, base_url = start_fake_provider(0, args.products, args.latency_ms, args.jitter_ms)
+    warmup = min(50, args.requests)
+    setup_keymaps(base_url, (args.requests * len(levels) + warmup) * 2)
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    server = make_server("127.0.0.1", 0, A.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    app_url = f"http://127.0.0.1:{server.server_port}"
+
+    print(f"Fake provider: {args.products} products, {args.latency_ms}ms + up to {args.jitter_ms}ms; "
+          f"catalog cache TTL {A.CATALOG_CACHE_TTL}s")
+    print(f"{'scenario':<15}{'conc':>6}{'reqs':>7}{'err':>6}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    results = []
+    for name in scenarios:
+        url = scenario_url(app_url, name)
+        run_level(url, warmup, 4)  # warm-up: kết nối, cache keymap/catalog
+        for conc in levels:
+            res = {"scenario": name, **run_level(url, args.requests, conc)}
+            results.append(res)
+            print(f"{name:<15}{conc:>6}{res['requests']:>7}{res['errors']:>6}{res['rps']:>10}"
+                  f"{res['p50_ms']:>10}{res['p95_ms']:>10}{res['p99_ms']:>10}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+    server.shutdown()
+    provider.shutdown()
+
+
+if __name__ == "__main__":
+    main()
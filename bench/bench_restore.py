@@ -0,0 +1,62 @@
+"""
+Benchmark khôi phục từ file backup lớn qua restore_backup_stream (cùng đường dùng cho
+/admin/backup/upload và auto-restore lúc khởi động). In số dòng/giây và RAM tối đa.
+
+Chạy:
+    python bench/bench_restore.py [số_dòng_kho] [gz]
+"""
+import json
+import gzip
+import os
+import resource
+import sys
+import tempfile
+import time
+
+_tmp_dir = tempfile.mkdtemp(prefix="bench_restore_")
+os.environ["DB_PATH"] = os.path.join(_tmp_dir, "restore.db")
+os.environ.setdefault("SECRET_BACKUP_FILE_PATH", os.path.join(_tmp_dir, "none.json"))
+os.environ.setdefault("FAST_BOOT", "0")
+os.environ["ADMIN_SECRET"] = "bench"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as A  # noqa: E402
+
+
+def make_backup(path, n_rows):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "wt", encoding="utf-8") as f:
+        f.write('{"generated_at": "bench", "journal_seq": 0, "config": {"ping_url": ""}, "proxies": [], "keymaps": [')
+        f.write(",".join(json.dumps({"sku": f"S{g}", "input_key": f"K{g}", "product_id": str(g), "is_active": 1,
+                                     "group_name": f"G{g}", "provider_type": "local"}) for g in range(100)))
+        f.write('], "local_stock": [')
+        for i in range(n_rows):
+            if i:
+                f.write(",")
+            f.write(json.dumps({"id": i + 1, "group_name": f"G{i % 100}",
+                                "content": f"user{i}@mail.test|Passw0rd{i}|recovery{i}@mail.test",
+                                "added_at": "2024-01-01 00:00:00"}))
+        f.write("]}")
+
+
+def main():
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    path = os.path.join(_tmp_dir, "backup.json.gz" if "gz" in sys.argv[2:] else "backup.json")
+    make_backup(path, n_rows)
+    size_mb = os.path.getsize(path) / 1024 / 1024
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    with A.open_backup_file(path) as f:
+        stats = A.restore_backup_stream(f)
+    elapsed = time.perf_counter() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    print(f"File: {n_rows} stock rows, {size_mb:.1f} MB")
+    print(f"Restored {stats['rows']} rows in {elapsed:.2f}s -> {stats['rows_per_sec']:,} rows/s "
+          f"(load {stats['load_seconds']}s, indexes/counts/FTS {stats['seconds'] - stats['load_seconds']:.2f}s)")
+    print(f"Peak RSS {rss_after / 1024:.0f} MB (before restore {rss_before / 1024:.0f} MB)")
+
+
+if __name__ == "__main__":
+    main()
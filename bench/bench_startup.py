@@ -0,0 +1,50 @@
+"""
+Đo thời gian khởi động: từ lúc import app.py tới khi nhận request được (live)
+và tới khi restore + quét proxy xong (ready), có và không có FAST_BOOT.
+
+Chạy:
+    python bench/bench_startup.py [số_lần]
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import json, sys, time
+sys.path.insert(0, %r)
+import app
+while not app.startup_state["ready"]:
+    time.sleep(0.005)
+print("STARTUP_JSON " + json.dumps(app.startup_state))
+""" % ROOT
+
+
+def measure(fast_boot):
+    tmp_dir = tempfile.mkdtemp(prefix="bench_boot_")
+    env = dict(os.environ)
+    env.update({
+        "DB_PATH": os.path.join(tmp_dir, "boot.db"),
+        "SECRET_BACKUP_FILE_PATH": env.get("SECRET_BACKUP_FILE_PATH", os.path.join(tmp_dir, "none.json")),
+        "FAST_BOOT": "1" if fast_boot else "0",
+    })
+    out = subprocess.run([sys.executable, "-c", CHILD], env=env, capture_output=True, text=True, check=True).stdout
+    line = next(l for l in out.splitlines() if l.startswith("STARTUP_JSON "))
+    return json.loads(line[len("STARTUP_JSON "):])
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    for fast_boot in (True, False):
+        results = [measure(fast_boot) for _ in range(runs)]
+        live = statistics.median(r["live_seconds"] for r in results)
+        ready = statistics.median(r["ready_seconds"] for r in results)
+        print(f"FAST_BOOT={'1' if fast_boot else '0'}: live {live:.3f}s, ready {ready:.3f}s (median of {runs})")
+
+
+if __name__ == "__main__":
+    main()
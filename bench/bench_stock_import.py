@@ -0,0 +1,63 @@
+"""
+Benchmark nhập kho hàng loạt qua /admin/local-stock/add với file lớn (mặc định 1 triệu dòng).
+In số dòng/giây và RAM tối đa của tiến trình (lưu ý: test client của Flask giữ nguyên body
+request trong RAM, nên RSS đo được gồm cả kích thước file upload).
+
+Chạy:
+    python bench/bench_stock_import.py [số_dòng] [tỉ_lệ_trùng_%]
+"""
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+_tmp_dir = tempfile.mkdtemp(prefix="bench_import_")
+os.environ["DB_PATH"] = os.path.join(_tmp_dir, "import.db")
+os.environ.setdefault("SECRET_BACKUP_FILE_PATH", os.path.join(_tmp_dir, "none.json"))
+os.environ.setdefault("FAST_BOOT", "0")
+os.environ["ADMIN_SECRET"] = "bench"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as A  # noqa: E402
+
+
+def make_file(path, n_lines, dup_pct):
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(n_lines):
+            if dup_pct and i and random.randint(1, 100) <= dup_pct:
+                i = random.randint(0, i - 1)
+            f.write(f"user{i}@mail.test|Passw0rd{i}|recovery{i}@mail.test\n")
+
+
+def main():
+    n_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    dup_pct = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    path = os.path.join(_tmp_dir, "stock.txt")
+    make_file(path, n_lines, dup_pct)
+    size_mb = os.path.getsize(path) / 1024 / 1024
+
+    client = A.app.test_client()
+    client.set_cookie("logged_in", "bench")
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    with open(path, "rb") as f:
+        resp = client.post(
+            "/admin/local-stock/add",
+            data={"group_name": "BENCH", "stock_file": (f, "stock.txt")},
+            content_type="multipart/form-data",
+        )
+    elapsed = time.perf_counter() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    stats = A.get_import_progress("BENCH")
+    print(f"File: {n_lines} lines, {size_mb:.1f} MB, ~{dup_pct}% duplicates (HTTP {resp.status_code})")
+    print(f"Inserted {stats['inserted']}, skipped {stats['skipped']}, duplicates {stats['duplicates']}")
+    print(f"Elapsed {elapsed:.2f}s -> {n_lines / elapsed:,.0f} rows/s")
+    print(f"Peak RSS {rss_after / 1024:.0f} MB (before upload {rss_before / 1024:.0f} MB)")
+
+
+if __name__ == "__main__":
+    main()
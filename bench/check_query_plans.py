@@ -0,0 +1,36 @@
+"""
+Kiểm tra EXPLAIN QUERY PLAN của các truy vấn nóng (app.HOT_QUERIES).
+Thoát với mã 1 nếu có bước SCAN không dùng chỉ mục phủ (toàn bảng hoặc USING INDEX + tra bảng), dùng được trong CI.
+Các bước SCAN ... USING COVERING INDEX vẫn được in ra để thấy truy vấn nào đọc hết 1 chỉ mục.
+
+Chạy:
+    python bench/check_query_plans.py
+"""
+import os
+import sys
+import tempfile
+
+_tmp_dir = tempfile.mkdtemp(prefix="qplan_")
+os.environ["DB_PATH"] = os.path.join(_tmp_dir, "qplan.db")
+os.environ.setdefault("SECRET_BACKUP_FILE_PATH", os.path.join(_tmp_dir, "none.json"))
+os.environ.setdefault("FAST_BOOT", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as A  # noqa: E402
+
+
+def main():
+    with A.db_read() as con:
+        problems = A.check_query_plans(con)
+        for name, sql, params in A.HOT_QUERIES + (A.HOT_QUERIES_FTS if A.stock_fts_available else []):
+            for plan_row in con.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall():
+                if plan_row[3].startswith("SCAN") and "USING COVERING INDEX" in plan_row[3]:
+                    print(f"INDEX SCAN: {name}: {plan_row[3]}")
+    for name, detail in problems:
+        print(f"SCAN: {name}: {detail}")
+    print(f"Checked {len(A.HOT_QUERIES) + (len(A.HOT_QUERIES_FTS) if A.stock_fts_available else 0)} queries, {len(problems)} scan(s) without a covering index.")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
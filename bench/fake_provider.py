@@ -0,0 +1,91 @@
+"""
+Nhà cung cấp giả lập API kiểu mail72h, chạy hoàn toàn offline để benchmark.
+- GET  /api/products.php?api_key=...  -> {"status": "success", "categories": [{"products": [...]}]}
+- POST /api/buy_product (action=buyProduct, id, amount, api_key) -> {"status": "success", "data": [...]}
+Kích thước danh mục và độ trễ (cố định + ngẫu nhiên) cấu hình được.
+
+Chạy độc lập:
+    python bench/fake_provider.py [cổng] [số_sản_phẩm] [độ_trễ_ms] [dao_động_ms]
+"""
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+def make_catalog(n_products, per_category=50):
+    categories = []
+    for start in range(0, n_products, per_category):
+        categories.append({
+            "name": f"Category {start // per_category}",
+            "products": [{"id": i + 1, "name": f"Product {i + 1}", "amount": (i * 7) % 1000}
+                         for i in range(start, min(start + per_category, n_products))],
+        })
+    return {"status": "success", "categories": categories}
+
+
+def start_fake_provider(port=0, n_products=500, latency_ms=20.0, jitter_ms=0.0):
+    """Khởi động server ở luồng nền. Trả về (server, base_url); gọi server.shutdown() để dừng."""
+    catalog_body = json.dumps(make_catalog(n_products)).encode()
+    counter = {"buys": 0}
+    counter_lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def _delay(self):
+            delay = latency_ms + (random.uniform(0, jitter_ms) if jitter_ms else 0)
+            if delay > 0:
+                time.sleep(delay / 1000)
+
+        def _send(self, body, status=200):
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if urlsplit(self.path).path != "/api/products.php":
+                return self._send(b'{"status": "error"}', 404)
+            self._delay()
+            self._send(catalog_body)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            form = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()}
+            if urlsplit(self.path).path != "/api/buy_product" or form.get("action") != "buyProduct":
+                return self._send(b'{"status": "error"}', 404)
+            self._delay()
+            amount = int(form.get("amount", 1))
+            with counter_lock:
+                start = counter["buys"]
+                counter["buys"] += amount
+            data = [f"acc{start + i}@fake.test|pass{start + i}" for i in range(amount)]
+            self._send(json.dumps({"status": "success", "data": data}).encode())
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+    n_products = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 20
+    jitter = float(sys.argv[4]) if len(sys.argv) > 4 else 0
+    server, url = start_fake_provider(port, n_products, latency, jitter)
+    print(f"Fake provider on {url} ({n_products} products, {latency}ms + up to {jitter}ms)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,100 @@
+"""
+Stress test song song cho fetch_local_stock: nhiều tiến trình x nhiều thread cùng lấy hàng
+từ nhiều nhóm trên cùng 1 file DB (mô phỏng nhiều worker Gunicorn).
+Kiểm tra không có item nào bị bán 2 lần, không mất item, và in thông lượng (fetches/s).
+Các lần lấy hàng (kể cả khác nhóm) vẫn tuần tự qua khóa ghi của SQLite: đây là bài kiểm tra tính đúng
+dưới tải song song, không đo được việc lấy hàng song song giữa các nhóm.
+
+Chạy:
+    python bench/stress_fetch_local.py [items_mỗi_nhóm] [số_nhóm] [số_tiến_trình] [thread_mỗi_tiến_trình]
+"""
+import multiprocessing as mp
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _import_app():
+    sys.path.insert(0, ROOT)
+    import app
+    return app
+
+
+def _worker(groups, threads, out_queue):
+    A = _import_app()
+    taken = []
+    fetches = [0]
+    lock = threading.Lock()
+
+    def run():
+        local_taken, local_fetches = [], 0
+        empty = set()
+        while len(empty) < len(groups):
+            grp = random.choice(groups)
+            if grp in empty:
+                continue
+            items = A.fetch_local_stock(grp, random.randint(1, 5))
+            local_fetches += 1
+            if not items:
+                empty.add(grp)
+            local_taken.extend(i["product"] for i in items)
+        with lock:
+            taken.extend(local_taken)
+            fetches[0] += local_fetches
+
+    ts = [threading.Thread(target=run) for _ in range(threads)]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    out_queue.put((taken, fetches[0]))
+
+
+def main():
+    per_group = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    n_groups = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    n_procs = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    n_threads = int(sys.argv[4]) if len(sys.argv) > 4 else 4
+
+    tmp_dir = tempfile.mkdtemp(prefix="stress_fetch_")
+    os.environ["DB_PATH"] = os.path.join(tmp_dir, "stress.db")
+    os.environ.setdefault("SECRET_BACKUP_FILE_PATH", os.path.join(tmp_dir, "none.json"))
+    os.environ.setdefault("FAST_BOOT", "0")
+    A = _import_app()
+
+    groups = [f"G{g}" for g in range(n_groups)]
+    with A.db() as con:
+        con.executemany(
+            "INSERT INTO local_stock(group_name, content, added_at) VALUES(?,?,?)",
+            [(g, f"{g}|item{i}", A.get_vn_time()) for g in groups for i in range(per_group)],
+        )
+    total = per_group * n_groups
+
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    procs = [ctx.Process(target=_worker, args=(groups, n_threads, queue)) for _ in range(n_procs)]
+    start = time.perf_counter()
+    for p in procs:
+        p.start()
+    results = [queue.get() for _ in procs]
+    elapsed = time.perf_counter() - start
+    for p in procs:
+        p.join()
+
+    taken = [item for items, _ in results for item in items]
+    fetches = sum(n for _, n in results)
+    duplicates = len(taken) - len(set(taken))
+
+    print(f"Items: {total} in {n_groups} groups, {n_procs} processes x {n_threads} threads")
+    print(f"Fetched: {len(taken)}, duplicates: {duplicates}, missing: {total - len(set(taken))}")
+    print(f"Throughput: {fetches / elapsed:.0f} fetches/s ({len(taken) / elapsed:.0f} items/s)")
+    return 0 if duplicates == 0 and len(taken) == total else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())